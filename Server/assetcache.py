@@ -0,0 +1,63 @@
+import os, hashlib
+
+
+class AssetCache(object):
+    """A directory of cached responses, keyed by strings.  The total
+    size of the files is kept below 'max_size' by removing the least
+    recently used ones.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get_path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest())
+
+    def get(self, key):
+        path = self.get_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+        try:
+            os.utime(path, None)      # for the LRU eviction
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        path = self.get_path(key)
+        tmpname = path + '.tmp'
+        try:
+            with open(tmpname, 'wb') as f:
+                f.write(data)
+            os.rename(tmpname, path)
+        except (IOError, OSError), e:
+            print "cannot write to the asset cache: %s" % (e,)
+            return
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
@@ -0,0 +1,105 @@
+import json
+import gzip
+import cStringIO
+import pickle
+import traceback
+import multiprocessing
+import tornado.ioloop
+from tornado.concurrent import Future
+
+import wireformat
+
+
+def build_compressed(build, args, kwds, binary):
+    # Runs in a worker process: returns the gzipped answer of
+    # 'build(*args, **kwds)', serialized in JSON or, if 'binary', in
+    # the format of wireformat.py.  Returns (True, data) or (False,
+    # exception), because multiprocessing.Pool in Python 2 has no way
+    # to report exceptions to the callback.
+    try:
+        result = build(*args, **kwds)
+        serialize = wireformat.encode if binary else json.dumps
+        f = cStringIO.StringIO()
+        g = gzip.GzipFile(fileobj=f, mode='wb', compresslevel=9)
+        g.write(serialize(result))
+        g.close()
+        return (True, f.getvalue())
+    except IndexError, e:
+        return (False, e)     # e.g. no such level chunk, not an error
+    except Exception, e:
+        traceback.print_exc()
+        try:
+            pickle.dumps(e)
+        except Exception:
+            e = RuntimeError("%s: %s" % (e.__class__.__name__, e))
+        return (False, e)
+
+
+class AssetPool(object):
+    """Builds the /level and /model responses in worker processes, so
+    that the event loop (and the simulation that runs in it) is not
+    blocked.  Concurrent requests for the same key share a single
+    build, whose result is put in 'cache' (an AssetCache).  With
+    'processes=0', the builds are done in this process.
+
+    If a worker process dies, Python 2's Pool replaces it but loses its
+    task without telling us; so a build that takes more than 'timeout'
+    seconds fails, and the next request for the same key starts again.
+    """
+
+    def __init__(self, processes, cache, timeout=300.0):
+        self.pool = multiprocessing.Pool(processes) if processes else None
+        self.cache = cache
+        self.timeout = timeout
+        self.pending = {}
+
+    def build(self, key, build, args=(), kwds=None, binary=False):
+        # Returns a Future for the gzipped answer.  'build' and its
+        # arguments must be picklable, e.g. a module-level function.
+        kwds = kwds or {}
+        try:
+            return self.pending[key]
+        except KeyError:
+            pass
+        future = self.pending[key] = Future()
+        io_loop = tornado.ioloop.IOLoop.current()
+
+        def done(result):
+            # called in the result thread of the pool
+            io_loop.add_callback(self._set_result, key, future, result)
+
+        if self.pool is None:
+            self._set_result(key, future,
+                             build_compressed(build, args, kwds, binary))
+        else:
+            self.pool.apply_async(build_compressed,
+                                  (build, args, kwds, binary),
+                                  callback=done)
+            io_loop.call_later(self.timeout, self._set_timeout, key, future)
+        return future
+
+    def _forget(self, key, future):
+        if self.pending.get(key) is future:
+            del self.pending[key]
+
+    def _set_result(self, key, future, (ok, result)):
+        self._forget(key, future)
+        if ok:
+            self.cache.put(key, result)
+        if future.done():
+            return          # too late, see _set_timeout()
+        if ok:
+            future.set_result(result)
+        else:
+            future.set_exception(result)
+
+    def _set_timeout(self, key, future):
+        if not future.done():
+            self._forget(key, future)
+            future.set_exception(RuntimeError(
+                "building %r: no answer from the worker after %g seconds"
+                % (key, self.timeout)))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
@@ -0,0 +1,98 @@
+import math
+
+
+def next_power_of_two(n):
+    result = 1
+    while result < n:
+        result *= 2
+    return result
+
+
+def pack_rectangles(sizes, width=None):
+    # Shelf packing of rectangles.  'sizes' is a list of (w, h).
+    # Returns (width, height, positions), where width and height are
+    # powers of two and 'positions' is a list of (x, y) corresponding
+    # to 'sizes'.  If 'width' is not given, it is chosen to make the
+    # result roughly square.
+    if width is None:
+        area = sum([w * h for w, h in sizes])
+        width = max([w for w, h in sizes] + [int(math.sqrt(area))])
+        width = next_power_of_two(width)
+    order = range(len(sizes))
+    order.sort(key=lambda i: (-sizes[i][1], -sizes[i][0]))
+    positions = [None] * len(sizes)
+    x = y = shelf_height = 0
+    for i in order:
+        w, h = sizes[i]
+        assert w <= width, "rectangle too wide for the atlas"
+        if x + w > width:
+            y += shelf_height
+            x = shelf_height = 0
+        positions[i] = (x, y)
+        x += w
+        shelf_height = max(shelf_height, h)
+    height = next_power_of_two(y + shelf_height)
+    return width, height, positions
+
+
+def blit_padded(page, pagewidth, x, y, data, w, h):
+    # Copy the w*h block 'data' in the bytearray 'page' with its corner
+    # at (x+1, y+1), surrounded by a 1-pixel frame duplicating the edge
+    # pixels, for bilinear filtering.  Uses (w+2)*(h+2) pixels.
+    rows = [data[j*w : (j+1)*w] for j in range(h)]
+    rows = [rows[0]] + rows + [rows[-1]]
+    for j, row in enumerate(rows):
+        ofs = (y + j) * pagewidth + x
+        page[ofs : ofs + w + 2] = row[0] + row + row[-1]
+
+
+def pack_pages(sizes, max_size):
+    # Like pack_rectangles(), but using several pages of at most
+    # max_size*max_size.  Returns (pages, positions), where 'pages' is
+    # a list of (width, height) and 'positions' a list of (page, x, y)
+    # corresponding to 'sizes'.
+    order = range(len(sizes))
+    order.sort(key=lambda i: (-sizes[i][1], -sizes[i][0]))
+    positions = [None] * len(sizes)
+    pages = []
+    x = y = shelf_height = 0
+    width = 0
+    for i in order:
+        w, h = sizes[i]
+        assert w <= max_size and h <= max_size, "rectangle too large"
+        if x + w > max_size:
+            y += shelf_height
+            x = shelf_height = 0
+        if not pages or y + h > max_size:
+            if pages:
+                pages[-1] = (width, y)
+            pages.append(None)
+            x = y = shelf_height = width = 0
+        positions[i] = (len(pages) - 1, x, y)
+        x += w
+        width = max(width, x)
+        shelf_height = max(shelf_height, h)
+    if pages:
+        pages[-1] = (width, y + shelf_height)
+    pages = [(next_power_of_two(w), next_power_of_two(h)) for w, h in pages]
+    return pages, positions
+
+
+def _wrap(seq, n, pad):
+    # the sequence of length n extended by 'pad' items on each side,
+    # as if it was repeated periodically
+    repeat = pad // n + 1
+    seq = seq * (2 * repeat + 1)
+    start = repeat * n - pad
+    return seq[start : start + n + 2 * pad]
+
+
+def blit_wrapped(page, pagewidth, x, y, data, w, h, pad):
+    # Copy the w*h block 'data' in the bytearray 'page' with its corner
+    # at (x+pad, y+pad), surrounded by a frame of 'pad' pixels taken
+    # from the opposite edges, for sampling a tiled texture near its
+    # edges.  Uses (w+2*pad)*(h+2*pad) pixels.
+    rows = [data[j*w : (j+1)*w] for j in range(h)]
+    for j, row in enumerate(_wrap(rows, h, pad)):
+        ofs = (y + j) * pagewidth + x
+        page[ofs : ofs + w + 2 * pad] = _wrap(row, w, pad)
@@ -0,0 +1,271 @@
+# Build the meshes of BSP models with whole-array operations: this is
+# the same work as the per-face loop in maploader.load_bsp_model(), but
+# resolving the edges into vertices, subdividing the sky, projecting the
+# texture coordinates and welding identical vertices are done with numpy
+# on all the faces of a model at once.  Requires the BSP to be loaded
+# with 'arrays=True'.
+
+from qdata import numpy
+
+
+SKY_MAX_DIST2 = 5000     # see maploader.explode_into_smaller_faces()
+TEX_SPECIAL = 1          # see maploader.TEX_SPECIAL
+LIGHT_STYLES = ('typelight', 'baselight', 'light0', 'light1')
+
+
+def can_build(bsp):
+    # the lumps are decoded lazily, and only get an 'array' if they were
+    # loaded with 'arrays=True'; hasattr() forces the decoding
+    return numpy is not None and all(
+        lump.arrays and hasattr(lump, 'array')
+        for lump in (bsp.faces, bsp.edges, bsp.ledges, bsp.vertexes,
+                     bsp.texinfo, bsp.planes))
+
+
+class BspMesh(object):
+    # 'positions', 'normals', 'uvs' and 'lightmap_uvs' are arrays with
+    # one row per vertex.  The polygons are given by 'sizes' (number of
+    # vertices), 'texids' and 'face_ids' (the BSP face they come from),
+    # and their vertex numbers are listed one after the other in
+    # 'corners'.
+    def __init__(self, positions, normals, uvs, lightmap_uvs,
+                 corners, sizes, texids, face_ids):
+        self.positions = positions
+        self.normals = normals
+        self.uvs = uvs
+        self.lightmap_uvs = lightmap_uvs
+        self.corners = corners
+        self.sizes = sizes
+        self.texids = texids
+        self.face_ids = face_ids
+
+
+def ragged_arange(starts, counts):
+    # concatenation of range(start, start + count) for all the pairs
+    total = counts.sum()
+    offsets = numpy.cumsum(counts) - counts
+    return (numpy.repeat(starts - offsets, counts) +
+            numpy.arange(total, dtype=numpy.intp))
+
+
+def get_face_corners(bsp, faces):
+    # the vertex numbers of the corners of all 'faces', one face after
+    # the other
+    counts = faces['ledge_num'].astype(numpy.intp)
+    eindex = bsp.ledges.array[ragged_arange(faces['ledge_id'], counts)]
+    edges = bsp.edges.array[numpy.abs(eindex)]
+    reverse = eindex < 0
+    vstart = numpy.where(reverse, edges['vertex1'], edges['vertex0'])
+    vend = numpy.where(reverse, edges['vertex0'], edges['vertex1'])
+    # check that the edges of each face form a loop
+    following = numpy.arange(1, len(vstart) + 1)
+    following[numpy.cumsum(counts) - 1] = numpy.cumsum(counts) - counts
+    assert (vstart[following] == vend).all()
+    return vstart, counts
+
+
+def get_lightmap_extents(bsp):
+    # Like CalcSurfaceExtents() on all the faces that have a lightmap, as
+    # in the loop of maploader.load_bsp_lightmaps().  Returns (face_ids,
+    # num_styles, styles, bmins, sizes): 'styles' has 4 columns, of which
+    # the first 'num_styles' are used, and 'bmins' and 'sizes' have 2,
+    # for the s and t texture axes.
+    faces = bsp.faces.array
+    styles = numpy.column_stack([faces[name] for name in LIGHT_STYLES])
+    num_styles = numpy.cumprod(styles != 255, axis=1).sum(axis=1)
+    texinfos = bsp.texinfo.array[faces['texinfo_id']]
+    face_ids = numpy.nonzero((faces['lightmap'] >= 0) &
+                             (texinfos['flags'] & TEX_SPECIAL == 0) &
+                             (num_styles > 0))[0]
+    faces = faces[face_ids]
+    texinfos = texinfos[face_ids]
+    bmins = numpy.zeros((len(face_ids), 2), int)
+    sizes = numpy.zeros((len(face_ids), 2), int)
+    if len(face_ids):
+        vindex, counts = get_face_corners(bsp, faces)
+        positions = bsp.vertexes.array[vindex].astype(float)
+        corner_face = numpy.repeat(numpy.arange(len(faces)), counts)
+        starts = numpy.cumsum(counts) - counts
+        x = positions[:, 0]
+        y = positions[:, 1]
+        z = positions[:, 2]
+        for i, name in enumerate(('s', 't')):
+            vec4 = texinfos[name].astype(float)[corner_face]
+            values = (x * vec4[:, 0] + y * vec4[:, 1] + z * vec4[:, 2] +
+                      vec4[:, 3])
+            bmin = numpy.floor(numpy.minimum.reduceat(values, starts) / 16.0)
+            bmax = numpy.ceil(numpy.maximum.reduceat(values, starts) / 16.0)
+            bmins[:, i] = bmin
+            sizes[:, i] = bmax - bmin + 1
+    return (face_ids, num_styles[face_ids], styles[face_ids], bmins,
+            sizes)
+
+
+def subdivide_sky(positions, counts, poly_index):
+    # Like maploader.triangulate() and explode_into_smaller_faces() on
+    # each polygon, level by level instead of recursively.  Returns
+    # (triangles, poly_index, keys): 'keys' sorts the triangles of a
+    # polygon in the order the recursive version would produce them.
+    starts = numpy.cumsum(counts) - counts
+    centers = (numpy.add.reduceat(positions, starts) /
+               counts[:, None].astype(float))
+    corner_poly = numpy.repeat(numpy.arange(len(counts)), counts)
+    previous = numpy.arange(-1, len(positions) - 1)
+    previous[starts] = starts + counts - 1
+    tris = numpy.empty((len(positions), 3, 3))
+    tris[:, 0] = centers[corner_poly]
+    tris[:, 1] = positions[previous]
+    tris[:, 2] = positions
+    keys = numpy.arange(len(positions)) - starts[corner_poly]
+    owners = poly_index[corner_poly]
+
+    done = []
+    depth = 0
+    while len(tris):
+        v1 = tris[:, 0]
+        v2 = tris[:, 1]
+        v3 = tris[:, 2]
+        split = ((((v1 - v2) ** 2).sum(axis=1) > SKY_MAX_DIST2) |
+                 (((v2 - v3) ** 2).sum(axis=1) > SKY_MAX_DIST2) |
+                 (((v1 - v3) ** 2).sum(axis=1) > SKY_MAX_DIST2))
+        keep = ~split
+        done.append((tris[keep], owners[keep], keys[keep], depth))
+        v1 = v1[split]
+        v2 = v2[split]
+        v3 = v3[split]
+        c1 = (v2 + v3) * 0.5
+        c2 = (v1 + v3) * 0.5
+        c3 = (v1 + v2) * 0.5
+        tris = numpy.concatenate([numpy.stack(child, axis=1) for child in
+                                  [(v1, c3, c2), (v2, c1, c3),
+                                   (v3, c2, c1), (c1, c2, c3)]])
+        keys = numpy.concatenate([keys[split] * 4 + j for j in range(4)])
+        owners = numpy.tile(owners[split], 4)
+        depth += 1
+        assert depth < 24, "sky polygon too large"
+
+    max_depth = depth - 1
+    tris = numpy.concatenate([t for t, _, _, _ in done])
+    owners = numpy.concatenate([o for _, o, _, _ in done])
+    keys = numpy.concatenate([k << (2 * (max_depth - d))
+                              for _, _, k, d in done])
+    return tris, owners, keys
+
+
+def weld(keys):
+    # Returns (first, inverse): 'first' is the index of the first row of
+    # each distinct row of 'keys', in order of appearance, and 'inverse'
+    # maps each row to the number of its distinct row.  Adding 0.0 turns
+    # -0.0 into 0.0, which must not be distinct.
+    keys = numpy.ascontiguousarray(keys + 0.0)
+    rows = keys.view(numpy.dtype((numpy.void, keys.dtype.itemsize *
+                                               keys.shape[1]))).ravel()
+    _, first, inverse = numpy.unique(rows, return_index=True,
+                                     return_inverse=True)
+    order = numpy.argsort(first, kind='mergesort')
+    renumber = numpy.empty_like(order)
+    renumber[order] = numpy.arange(len(order))
+    return first[order], renumber[inverse]
+
+
+def build_meshes(bsp, model, face_lightmaps=None, liquids=None,
+                 face_ids=None):
+    # Returns a list of BspMesh for the faces of 'model', or for the
+    # faces listed in 'face_ids' if given: if 'liquids' is None, a single
+    # mesh with all of them; otherwise, 'liquids' says for each texture
+    # if it is a liquid, and the result is [solid mesh, liquid mesh].
+    if face_ids is None:
+        face_ids = numpy.arange(model.face_id,
+                                model.face_id + model.face_num)
+    else:
+        face_ids = numpy.array(face_ids, int)
+    faces = bsp.faces.array[face_ids]
+    texinfos = bsp.texinfo.array[faces['texinfo_id']]
+    texids = texinfos['miptex']
+
+    textures = bsp.textures.list
+    is_sky = numpy.array([tex.name.startswith('sky') for tex in textures],
+                         bool)
+    tex_isize = numpy.array([(1.0 / tex.width, 1.0 / tex.height)
+                             for tex in textures], float).reshape(-1, 2)
+
+    # the polygons: a sky face is replaced with many small triangles
+    vindex, counts = get_face_corners(bsp, faces)
+    positions = bsp.vertexes.array[vindex].astype(float)
+    sky_faces = is_sky[texids]
+    if sky_faces.any():
+        sky_corners = numpy.repeat(sky_faces, counts)
+        tris, sky_owners, sky_keys = subdivide_sky(
+            positions[sky_corners], counts[sky_faces],
+            numpy.nonzero(sky_faces)[0])
+        keep = ~sky_faces
+        positions = numpy.concatenate([positions[~sky_corners],
+                                       tris.reshape(-1, 3)])
+        counts = numpy.concatenate([counts[keep],
+                                    numpy.repeat(3, len(tris))])
+        poly_face = numpy.concatenate([numpy.nonzero(keep)[0], sky_owners])
+        poly_key = numpy.concatenate([numpy.zeros(keep.sum(), int),
+                                      sky_keys])
+        order = numpy.lexsort((poly_key, poly_face))
+        starts = numpy.cumsum(counts) - counts
+        positions = positions[ragged_arange(starts[order], counts[order])]
+        counts = counts[order]
+        poly_face = poly_face[order]
+    else:
+        poly_face = numpy.arange(len(faces))
+    corner_face = numpy.repeat(poly_face, counts)
+
+    # texture coordinates, in texels
+    s4 = texinfos['s'].astype(float)[corner_face]
+    t4 = texinfos['t'].astype(float)[corner_face]
+    x = positions[:, 0]
+    y = positions[:, 1]
+    z = positions[:, 2]
+    s = x * s4[:, 0] + y * s4[:, 1] + z * s4[:, 2] + s4[:, 3]
+    t = x * t4[:, 0] + y * t4[:, 1] + z * t4[:, 2] + t4[:, 3]
+    isize = tex_isize[texids[corner_face]]
+    uvs = numpy.column_stack([s * isize[:, 0], t * isize[:, 1]])
+
+    planes = bsp.planes.array[faces['plane_id']]
+    sides = numpy.where(faces['side'] == 0, 1.0, -1.0)
+    normals = (planes['normal'].astype(float) * sides[:, None])[corner_face]
+
+    # lightmap coordinates, see maploader.load_bsp_lightmaps()
+    lightmaps = numpy.zeros((len(faces), 4))
+    lit = numpy.zeros(len(faces), bool)
+    if face_lightmaps:
+        for i, face_id in enumerate(face_ids.tolist()):
+            if face_id in face_lightmaps:
+                lightmaps[i] = face_lightmaps[face_id][:4]
+                lit[i] = True
+    lightmaps = lightmaps[corner_face]
+    lightmap_uvs = numpy.column_stack(
+        [(lightmaps[:, 0] + s / 16.0) * lightmaps[:, 2],
+         (lightmaps[:, 1] + t / 16.0) * lightmaps[:, 3]])
+    lightmap_uvs[~lit[corner_face]] = 0.0
+
+    keys = numpy.column_stack([positions, normals,
+                               numpy.round(uvs, 3),
+                               numpy.round(lightmap_uvs, 5)])
+
+    if liquids is None:
+        groups = [numpy.ones(len(counts), bool)]
+    else:
+        poly_liquid = numpy.array(liquids, bool)[texids[poly_face]]
+        groups = [~poly_liquid, poly_liquid]
+
+    corner_poly = numpy.repeat(numpy.arange(len(counts)), counts)
+    result = []
+    for in_group in groups:
+        corners = in_group[corner_poly]
+        first, inverse = weld(keys[corners])
+        positions1 = positions[corners][first]
+        result.append(BspMesh(positions1,
+                              normals[corners][first],
+                              uvs[corners][first],
+                              lightmap_uvs[corners][first],
+                              inverse,
+                              counts[in_group],
+                              texids[poly_face[in_group]],
+                              face_ids[poly_face[in_group]]))
+    return result
@@ -1,17 +1,49 @@
 import os
+import sys
 import qdata
+import searchpath
+import atlas
+import bspmesh
+import meshopt
+import visibility
 import array
+import math
 
 
-MAPDATA_VERSION = 19
+MAPDATA_VERSION = 22
 
-QDATA = [qdata.load('id1/pak0.pak')]
-if os.path.exists('id1/pak1.pak'):
-    QDATA.append(qdata.load('id1/pak1.pak'))
+TEX_SPECIAL = 1     # texinfo flag: sky or liquid, without lightmap
 
-CONTENT = {}
-for _qdata in QDATA:
-    CONTENT.update(_qdata.content)
+ATLAS_MAX_SIZE = 2048
+ATLAS_PADDING = 4
+
+STREAM_CHUNK_SIZE = 512     # size of the cubes of the level streaming
+
+USE_ARRAYS = qdata.numpy is not None
+
+# game directories from the '-game' argument, which is also given to
+# Quake.  The server sets 'CONTENT.index_filename' in its cache directory;
+# nothing is read before the first access.
+CONTENT = searchpath.SearchPath(searchpath.get_game_dirs(sys.argv[1:]),
+                                arrays=USE_ARRAYS)
+
+
+def get_cache_key(kind, name, **options):
+    # a key for the result of load_level() or load_model(), which
+    # depends on the content of all the files that they read and on
+    # the keyword arguments given to them
+    for option in sorted(options):
+        value = options[option]
+        if value is True:
+            kind += '+' + option
+        elif value is not False and value is not None:
+            kind += '+%s=%s' % (option, value)
+    if kind.startswith('level'):
+        sources = ['maps/%s.bsp' % (name,), 'gfx/palette.lmp']
+    else:
+        sources = [name]
+    digests = [CONTENT.get_digest(source) for source in sources]
+    return '%s:%s:%d:%s' % (kind, name, MAPDATA_VERSION, ':'.join(digests))
 
 
 def map_vertex((x, y, z)):
@@ -41,21 +73,33 @@ def load_palette():
     return r_palette
 
 
-def load_level(levelname):
+def load_level(levelname, use_atlas=False, stream=False):
+    # With 'stream=True', returns only the manifest for streaming the
+    # level: model 0 and the liquid model are empty, and 'chunks' lists
+    # the pieces to fetch with load_level_chunk(), nearest to the player
+    # start first.  'textures' only have the 'data' needed by the other
+    # models; the rest comes with the chunks.
     bsp = CONTENT['maps/%s.bsp' % (levelname,)]
     result = {}
 
-    r_textures = load_bsp_textures(bsp)
+    r_textures, r_atlas_pages, r_lightmaps, face_lightmaps = \
+        load_level_textures(bsp, use_atlas)
+    if use_atlas:
+        result['atlas_pages'] = r_atlas_pages
     r_models = []
 
-    r_models.append(load_bsp_model(bsp, bsp.models[0], r_textures,
-                                   liquid_check=False))
+    if stream:
+        world_model, liquid_model = load_bsp_world(bsp, r_textures,
+                                                   face_lightmaps, [])
+    else:
+        world_model, liquid_model = load_bsp_world(bsp, r_textures,
+                                                   face_lightmaps)
+    r_models.append(world_model)
 
     for i in range(1, len(bsp.models)):
-        r_models.append(load_bsp_model(bsp, bsp.models[i], r_textures))
+        r_models.append(load_bsp_model(bsp, bsp.models[i], r_textures,
+                                       face_lightmaps=face_lightmaps))
 
-    liquid_model = load_bsp_model(bsp, bsp.models[0], r_textures,
-                                  liquid_check=True)
     if liquid_model['faces']:
         result['liquid_model'] = len(r_models)
         r_models.append(liquid_model)
@@ -64,21 +108,206 @@ def load_level(levelname):
 
     result['palette'] = load_palette()
 
-    result['textures'] = r_textures
+    if stream:
+        manifest_texids, chunks = get_level_cached(
+            bsp, 'chunks', lambda: get_level_chunks(bsp, r_textures))
+        result['textures'] = [
+            strip_texture_data(r_texture, texid in manifest_texids)
+            for texid, r_texture in enumerate(r_textures)]
+        result['chunks'] = [{'mins': map_vertex(chunk['mins']),
+                             'maxs': map_vertex(chunk['maxs']),
+                             'faces': len(chunk['face_ids'])}
+                            for chunk in chunks]
+        result['start_pos'] = map_vertex(get_start_position(bsp))
+    else:
+        result['textures'] = r_textures
+
+    result['lightmaps'] = r_lightmaps
 
     r_lights = []
-    for entity in qdata.parse_entities(bsp.entities.rawdata):
+    for entity in bsp.entities.list:
         if entity.get('classname', '').startswith('light'):
             r_lights.append(load_light(entity))
     result['lights'] = r_lights
 
-    bspnodes, bspleafs = load_bsp_tree(bsp, bsp.models[0].node_id0)
+    bsptree = load_bsp_tree(bsp, bsp.models[0].node_id0)
+    result['bsptree'] = bsptree
+    bspnodes, bspleafs = get_bsp_tree_nodes(bsptree)     # older clients
     result['bspnodes'] = bspnodes
     result['bspleafs'] = bspleafs
 
     return result
 
 
+def load_level_chunk(levelname, index, use_atlas=False):
+    # The chunk number 'index' of the level, as listed in the 'chunks'
+    # of load_level(stream=True): 'model' and 'liquid_model' are two
+    # models with the faces of the chunk, with the vertex numbers local
+    # to the chunk, and 'textures' is the list of textures that are
+    # needed for the first time in this chunk, with a 'texid' key.
+    bsp = CONTENT['maps/%s.bsp' % (levelname,)]
+    r_textures, _, _, face_lightmaps = load_level_textures(bsp, use_atlas)
+    manifest_texids, chunks = get_level_cached(
+        bsp, 'chunks', lambda: get_level_chunks(bsp, r_textures))
+    chunk = chunks[index]
+    solid, liquid = load_bsp_world(bsp, r_textures, face_lightmaps,
+                                   chunk['face_ids'])
+    r_textures_needed = []
+    for texid in chunk['new_texids']:
+        r_texture = dict(r_textures[texid])
+        r_texture['texid'] = texid
+        r_textures_needed.append(r_texture)
+    return {
+        'index': index,
+        'model': solid,
+        'liquid_model': liquid,
+        'textures': r_textures_needed,
+        }
+
+
+_level_cache = {}     # {key: (bsp, value)}, only for the last level
+
+def get_level_cached(bsp, key, build):
+    # the results of load_level_textures() and get_level_chunks() are
+    # needed again by all the load_level_chunk() calls.  The caller must
+    # not modify them.
+    try:
+        cached_bsp, result = _level_cache[key]
+    except KeyError:
+        pass
+    else:
+        if cached_bsp is bsp:
+            return result
+    result = build()
+    for key1, (cached_bsp, _) in _level_cache.items():
+        if cached_bsp is not bsp:
+            del _level_cache[key1]
+    _level_cache[key] = (bsp, result)
+    return result
+
+
+def load_level_textures(bsp, use_atlas):
+    # Returns (r_textures, r_atlas_pages, r_lightmaps, face_lightmaps)
+    def build():
+        r_textures = load_bsp_textures(bsp)
+        r_atlas_pages = None
+        if use_atlas:
+            r_atlas_pages = load_texture_atlas(bsp, r_textures)
+        r_lightmaps, face_lightmaps = load_bsp_lightmaps(bsp)
+        return (r_textures, r_atlas_pages, r_lightmaps, face_lightmaps)
+    return get_level_cached(bsp, ('textures', use_atlas), build)
+
+
+def strip_texture_data(r_texture, keep_data):
+    if r_texture is None or keep_data or 'data' not in r_texture:
+        return r_texture
+    r_texture = dict(r_texture)
+    del r_texture['data']
+    return r_texture
+
+
+def get_start_position(bsp):
+    # like QuakeServer.get_player_start_position(), but from the entities
+    # of the BSP instead of the running server
+    for entity in bsp.entities.by_classname.get('info_player_start', []):
+        if 'origin' in entity:
+            return qdata.parse_vec3(entity['origin'])
+    return (0.0, 0.0, 0.0)
+
+
+def get_texture_closure(r_textures, texids):
+    # the textures 'texids', plus all the textures of their animations
+    result = set()
+    pending = list(texids)
+    while pending:
+        texid = pending.pop()
+        if texid in result:
+            continue
+        result.add(texid)
+        r_texture = r_textures[texid]
+        if r_texture is not None:
+            for key in ('anim_next', 'anim_alt'):
+                if key in r_texture:
+                    pending.append(r_texture[key])
+    return result
+
+
+def get_level_chunks(bsp, r_textures):
+    # Split the faces of the world into chunks, one per cube of
+    # STREAM_CHUNK_SIZE containing the center of the faces.  The chunks
+    # in the PVS of the player start come first, then the others; in
+    # both cases the nearest to the player start first.  Returns
+    # (manifest_texids, chunks), where 'manifest_texids' are the
+    # textures of the other models and each chunk is a dict with
+    # 'face_ids', 'mins', 'maxs' and 'new_texids' (the textures that
+    # are not in 'manifest_texids' or in a previous chunk).
+    vertexes = bsp.vertexes.list
+    edges = bsp.edges.list
+    ledges = bsp.ledges.list
+    faces = bsp.faces.list
+
+    def face_texid(face_index):
+        return bsp.texinfo[faces[face_index].texinfo_id].miptex
+
+    manifest_texids = set()
+    for model in bsp.models.list[1:]:
+        for face_index in range(model.face_id,
+                                model.face_id + model.face_num):
+            manifest_texids.add(face_texid(face_index))
+    manifest_texids = get_texture_closure(r_textures, manifest_texids)
+
+    start = get_start_position(bsp)
+    vis = visibility.LevelVisibility(bsp)
+    start_pvs = vis.fat_pvs(start)
+    visible_faces = set()
+    lface = bsp.lface.list
+    for leaf_index, leaf in enumerate(bsp.leafs.list):
+        if start_pvs is None or start_pvs & (1 << leaf_index):
+            visible_faces.update(lface[leaf.lface_id :
+                                       leaf.lface_id + leaf.lface_num])
+
+    cells = {}
+    model = bsp.models[0]
+    for face_index in range(model.face_id, model.face_id + model.face_num):
+        vlist = get_face_vertices(faces[face_index], vertexes, edges,
+                                  ledges)
+        mins = tuple(map(min, zip(*vlist)))
+        maxs = tuple(map(max, zip(*vlist)))
+        cell = tuple([int(math.floor((lo + hi) * 0.5 / STREAM_CHUNK_SIZE))
+                      for lo, hi in zip(mins, maxs)])
+        key = (face_index not in visible_faces, cell)
+        try:
+            chunk = cells[key]
+        except KeyError:
+            chunk = cells[key] = {'face_ids': [], 'mins': mins,
+                                  'maxs': maxs}
+        chunk['face_ids'].append(face_index)
+        chunk['mins'] = tuple(map(min, chunk['mins'], mins))
+        chunk['maxs'] = tuple(map(max, chunk['maxs'], maxs))
+
+    def distance2(chunk):
+        # from the player start to the nearest point of the chunk's box
+        result = 0.0
+        for x, lo, hi in zip(start, chunk['mins'], chunk['maxs']):
+            d = max(lo - x, 0.0, x - hi)
+            result += d * d
+        return result
+
+    chunks = []
+    for key in sorted(cells, key=lambda key: (key[0], distance2(cells[key]),
+                                              key)):
+        chunks.append(cells[key])
+
+    texids_seen = set(manifest_texids)
+    for chunk in chunks:
+        texids = get_texture_closure(
+            r_textures, [face_texid(face_index)
+                         for face_index in chunk['face_ids']])
+        chunk['new_texids'] = sorted(texids - texids_seen)
+        texids_seen |= texids
+    return manifest_texids, chunks
+
+
 def load_bsp_textures(bsp):
     names2texid = {}
     for texid, tex in enumerate(bsp.textures):
@@ -120,6 +349,64 @@ def load_bsp_textures(bsp):
     return r_textures
 
 
+def load_texture_atlas(bsp, r_textures):
+    # Move the textures that are not sky or liquid into a few atlas
+    # pages.  Their 'data' is removed and replaced with 'atlas':
+    # {'page', 'x', 'y'}, the position of the texture in the page; the
+    # uvs of the faces are unchanged, i.e. the client must wrap them
+    # inside the texture's rectangle.  Around each rectangle there are
+    # ATLAS_PADDING pixels copied from the opposite edges, so that
+    # sampling near the edges gives the same result as a tiled texture.
+    # Animated textures also get 'atlas_frames' and maybe
+    # 'atlas_alt_frames', the rectangles of the 'anim_next' cycle
+    # starting at this texture and at 'anim_alt'.
+    pad = ATLAS_PADDING
+    texids = []
+    for texid, r_texture in enumerate(r_textures):
+        if r_texture is None or 'effect' in r_texture:
+            continue
+        if max(r_texture['width'], r_texture['height']) + 2 * pad > \
+                ATLAS_MAX_SIZE:
+            continue      # stays a texture of its own
+        texids.append(texid)
+    if not texids:
+        return []
+
+    pages, positions = atlas.pack_pages(
+        [(r_textures[texid]['width'] + 2 * pad,
+          r_textures[texid]['height'] + 2 * pad) for texid in texids],
+        ATLAS_MAX_SIZE)
+    r_pages = [bytearray(width * height) for width, height in pages]
+    for texid, (page, x, y) in zip(texids, positions):
+        r_texture = r_textures[texid]
+        atlas.blit_wrapped(r_pages[page], pages[page][0], x, y,
+                           bsp.textures[texid].mipmaps[0].data,
+                           r_texture['width'], r_texture['height'], pad)
+        del r_texture['data']
+        r_texture['atlas'] = {'page': page, 'x': x + pad, 'y': y + pad}
+
+    def get_frames(texid):
+        frames = []
+        seen = set()
+        while texid not in seen and 'atlas' in r_textures[texid]:
+            seen.add(texid)
+            frames.append(r_textures[texid]['atlas'])
+            texid = r_textures[texid].get('anim_next', texid)
+        return frames
+
+    for texid in texids:
+        r_texture = r_textures[texid]
+        if 'anim_next' in r_texture:
+            r_texture['atlas_frames'] = get_frames(texid)
+            if 'anim_alt' in r_texture:
+                r_texture['atlas_alt_frames'] = get_frames(
+                    r_texture['anim_alt'])
+
+    return [{'width': width, 'height': height,
+             'data': str(r_page).encode('base64')}
+            for (width, height), r_page in zip(pages, r_pages)]
+
+
 def load_light(entity):
     e_light = entity.get('light', 200)
     result = {
@@ -131,20 +418,209 @@ def load_light(entity):
     return result
 
 
-def load_bsp_model(bsp, model, r_textures=None, liquid_check=None):
+def get_face_vertices(face, vertexes, edges, ledges):
+    vlist0 = []
+    vlist1 = []
+    for lindex in range(face.ledge_id, face.ledge_id + face.ledge_num):
+        eindex = ledges[lindex]
+        edge = edges[abs(eindex)]
+        v0, v1 = edge.vertex0, edge.vertex1
+        if eindex < 0:
+            v0, v1 = v1, v0
+        vlist0.append(v0)
+        vlist1.append(v1)
+    assert vlist0[1:] + vlist0[:1] == vlist1
+    return [vertexes[vindex] for vindex in vlist0]
+
+
+def load_bsp_lightmaps(bsp):
+    # Pack the lightmaps of all faces into an atlas.  Returns a list of
+    # textures, one per light style slot: the lightmap for the k-th style
+    # of a face is at the same place in the k-th texture.  Also returns
+    # {face_index: (u0, v0, i_width, i_height, styles)}, used by
+    # load_bsp_model() to compute the lightmap coordinates of a vertex
+    # ((u0 + s/16) * i_width, (v0 + t/16) * i_height), where (s, t) are
+    # its texture coordinates in texels.
+    lighting = bsp.lighting.rawdata
+    if bspmesh.can_build(bsp):
+        blocks = []
+        face_ids, num_styles, styles, bmins, sizes = (
+            bspmesh.get_lightmap_extents(bsp))
+        lightmap_ofs = bsp.faces.array['lightmap'][face_ids]
+        for face_index, n, face_styles, face_bmins, (smax, tmax), ofs in zip(
+                face_ids.tolist(), num_styles.tolist(), styles.tolist(),
+                bmins.tolist(), sizes.tolist(), lightmap_ofs.tolist()):
+            if ofs + n * smax * tmax > len(lighting):
+                continue
+            blocks.append((face_index, smax, tmax, face_bmins,
+                           face_styles[:n], ofs))
+    else:
+        blocks = get_lightmap_blocks(bsp, lighting)
+
+    if not blocks:
+        return [], {}
+
+    width, height, positions = atlas.pack_rectangles(
+        [(smax + 2, tmax + 2) for _, smax, tmax, _, _, _ in blocks])
+    num_pages = max([len(styles) for _, _, _, _, styles, _ in blocks])
+    pages = [bytearray(width * height) for k in range(num_pages)]
+    face_lightmaps = {}
+    for (face_index, smax, tmax, bmins, styles, ofs), (x, y) in zip(
+            blocks, positions):
+        size = smax * tmax
+        for k in range(len(styles)):
+            atlas.blit_padded(pages[k], width, x, y,
+                              lighting[ofs + k * size : ofs + (k+1) * size],
+                              smax, tmax)
+        # +1 for the padding, +0.5 for the center of the texels
+        face_lightmaps[face_index] = (x + 1.5 - bmins[0],
+                                      y + 1.5 - bmins[1],
+                                      1.0 / width, 1.0 / height,
+                                      styles)
+    r_lightmaps = [{'width': width, 'height': height,
+                    'data': str(page).encode('base64')} for page in pages]
+    return r_lightmaps, face_lightmaps
+
+
+def get_lightmap_blocks(bsp, lighting):
+    # the loop version of bspmesh.get_lightmap_extents(), without arrays:
+    # a list of (face_index, smax, tmax, bmins, styles, lightmap offset)
+    vertexes = bsp.vertexes.list
+    edges = bsp.edges.list
+    ledges = bsp.ledges.list
+    blocks = []
+    for face_index, face in enumerate(bsp.faces.list):
+        if face.lightmap < 0:
+            continue
+        texinfo = bsp.texinfo[face.texinfo_id]
+        if texinfo.flags & TEX_SPECIAL:
+            continue
+        styles = []
+        for style in (face.typelight, face.baselight, face.light0,
+                      face.light1):
+            if style == 255:
+                break
+            styles.append(style)
+        if not styles:
+            continue
+        # like CalcSurfaceExtents()
+        vlist = get_face_vertices(face, vertexes, edges, ledges)
+        bmins = []
+        sizes = []
+        for vec4 in (texinfo.s, texinfo.t):
+            values = [v[0] * vec4[0] + v[1] * vec4[1] + v[2] * vec4[2] +
+                      vec4[3] for v in vlist]
+            bmin = int(math.floor(min(values) / 16.0))
+            bmax = int(math.ceil(max(values) / 16.0))
+            bmins.append(bmin)
+            sizes.append(bmax - bmin + 1)
+        smax, tmax = sizes
+        if face.lightmap + len(styles) * smax * tmax > len(lighting):
+            continue
+        blocks.append((face_index, smax, tmax, bmins, styles, face.lightmap))
+    return blocks
+
+
+def get_liquid_textures(r_textures):
+    return [r_texture is not None and r_texture.get('effect') == 'water'
+            for r_texture in r_textures]
+
+def load_bsp_world(bsp, r_textures, face_lightmaps, face_ids=None):
+    # returns the models for the solid faces and for the liquid faces
+    # of the world, or of the faces listed in 'face_ids'; with arrays,
+    # they are built in a single pass
+    if bspmesh.can_build(bsp):
+        solid, liquid = bspmesh.build_meshes(
+            bsp, bsp.models[0], face_lightmaps,
+            liquids=get_liquid_textures(r_textures), face_ids=face_ids)
+        return (load_bsp_mesh(solid, face_lightmaps),
+                load_bsp_mesh(liquid, None))
+    return (load_bsp_model(bsp, bsp.models[0], r_textures,
+                           liquid_check=False,
+                           face_lightmaps=face_lightmaps,
+                           face_ids=face_ids),
+            load_bsp_model(bsp, bsp.models[0], r_textures,
+                           liquid_check=True, face_ids=face_ids))
+
+def load_bsp_mesh(mesh, face_lightmaps):
+    # turn a bspmesh.BspMesh into the same result as load_bsp_model()
+    corners = mesh.corners.tolist()
+    r_faces = []
+    start = 0
+    for size, texid, face_index in zip(mesh.sizes.tolist(),
+                                       mesh.texids.tolist(),
+                                       mesh.face_ids.tolist()):
+        r_face = {'v': corners[start:start + size], 't': texid}
+        start += size
+        if face_lightmaps and face_index in face_lightmaps:
+            r_face['ls'] = face_lightmaps[face_index][4]
+        r_faces.append(r_face)
+
+    result = {
+        'frames': [{'a': [{'v': map(map_vertex, mesh.positions.tolist()),
+                           'n': map(map_vertex, mesh.normals.tolist())}]}],
+        'uvs': [{'x': u, 'y': v} for u, v in mesh.uvs.tolist()],
+        'faces': r_faces,
+        }
+    if face_lightmaps:
+        result['lightmap_uvs'] = [{'x': u, 'y': v} for u, v in
+                                  mesh.lightmap_uvs.tolist()]
+    return add_index_buffers(result)
+
+def add_index_buffers(result):
+    # Adds 'submeshes' to the result of load_bsp_model() or load_model():
+    # a list of {'t': texid, 'triangles': [indices]}, with also 'ls' for
+    # lightmapped faces, ready to be drawn with one call each.  The
+    # vertices are renumbered, see meshopt.build_index_buffers().
+    submeshes, order = meshopt.build_index_buffers(result['faces'],
+                                                   len(result['uvs']))
+    result['submeshes'] = submeshes
+
+    def reorder(items):
+        return [items[i] for i in order]
+    result['uvs'] = reorder(result['uvs'])
+    if 'lightmap_uvs' in result:
+        result['lightmap_uvs'] = reorder(result['lightmap_uvs'])
+    for r_frame in result['frames']:
+        for r_pose in r_frame['a']:
+            for key in ('v', 'n'):
+                if key in r_pose:
+                    r_pose[key] = reorder(r_pose[key])
+            if 'trivertx' in r_pose:
+                data = r_pose['trivertx'].decode('base64')
+                data = ''.join([data[i * 4 : i * 4 + 4] for i in order])
+                r_pose['trivertx'] = data.encode('base64')
+    return result
+
+def load_bsp_model(bsp, model, r_textures=None, liquid_check=None,
+                   face_lightmaps=None, face_ids=None):
+    if bspmesh.can_build(bsp):
+        if liquid_check is None:
+            [mesh] = bspmesh.build_meshes(bsp, model, face_lightmaps,
+                                          face_ids=face_ids)
+        else:
+            meshes = bspmesh.build_meshes(
+                bsp, model, face_lightmaps,
+                liquids=get_liquid_textures(r_textures), face_ids=face_ids)
+            mesh = meshes[liquid_check]
+        return load_bsp_mesh(mesh, face_lightmaps)
+
     r_vertices = []
     r_uvs = []
+    r_lightmap_uvs = []
     r_normals = []
 
     _vertex_cache = {}
-    def get_vertex(vec3, norm3, u, v):
-        key = (vec3, norm3, round(u, 3), round(v, 3))
+    def get_vertex(vec3, norm3, u, v, lu=0.0, lv=0.0):
+        key = (vec3, norm3, round(u, 3), round(v, 3), round(lu, 5),
+               round(lv, 5))
         try:
             result = _vertex_cache[key]
         except KeyError:
             result = len(r_vertices)
             r_vertices.append(map_vertex(vec3))
             r_uvs.append({'x': u, 'y': v})
+            r_lightmap_uvs.append({'x': lu, 'y': lv})
             r_normals.append(map_vertex(norm3))
             _vertex_cache[key] = result
         return result
@@ -153,8 +629,12 @@ def load_bsp_model(bsp, model, r_textures=None, liquid_check=None):
     edges = bsp.edges.list
     ledges = bsp.ledges.list
 
+    if face_ids is None:
+        face_ids = range(model.face_id, model.face_id + model.face_num)
     r_faces = []
-    for face in bsp.faces.list[model.face_id : model.face_id + model.face_num]:
+    faces = bsp.faces.list
+    for face_index in face_ids:
+        face = faces[face_index]
         texinfo = bsp.texinfo[face.texinfo_id]
         texid = texinfo.miptex
 
@@ -163,24 +643,11 @@ def load_bsp_model(bsp, model, r_textures=None, liquid_check=None):
             if is_water != liquid_check:
                 continue
 
-        vnum = face.ledge_num
-        vlist0 = []
-        vlist1 = []
-        for lindex in range(face.ledge_id, face.ledge_id + face.ledge_num):
-            eindex = ledges[lindex]
-            edge = edges[abs(eindex)]
-            v0, v1 = edge.vertex0, edge.vertex1
-            if eindex < 0:
-                v0, v1 = v1, v0
-            vlist0.append(v0)
-            vlist1.append(v1)
-        assert vlist0[1:] + vlist0[:1] == vlist1
-
         s4 = texinfo.s
         t4 = texinfo.t
         tex = bsp.textures[texid]
 
-        vlist0 = [vertexes[vindex] for vindex in vlist0]
+        vlist0 = get_face_vertices(face, vertexes, edges, ledges)
         if tex.name.startswith('sky'):
             vlistlist = []
             for vtri in triangulate(vlist0):
@@ -193,20 +660,37 @@ def load_bsp_model(bsp, model, r_textures=None, liquid_check=None):
         normal = bsp.planes[face.plane_id].normal
         side = 1.0 if face.side == 0 else -1.0
         normal = (side * normal[0], side * normal[1], side * normal[2])
+        if face_lightmaps and face_index in face_lightmaps:
+            lu0, lv0, i_lwidth, i_lheight, styles = face_lightmaps[face_index]
+        else:
+            styles = None
         for vlist in vlistlist:
             r_v = []
             for k, v in enumerate(vlist):
                 s = v[0] * s4[0] + v[1] * s4[1] + v[2] * s4[2] + s4[3]
                 t = v[0] * t4[0] + v[1] * t4[1] + v[2] * t4[2] + t4[3]
-                r_v.append(get_vertex(v, normal, s * i_width, t * i_height))
-            r_faces.append({'v': r_v, 't': texid})
+                if styles:
+                    lu = (lu0 + s / 16.0) * i_lwidth
+                    lv = (lv0 + t / 16.0) * i_lheight
+                    r_v.append(get_vertex(v, normal, s * i_width,
+                                          t * i_height, lu, lv))
+                else:
+                    r_v.append(get_vertex(v, normal, s * i_width,
+                                          t * i_height))
+            r_face = {'v': r_v, 't': texid}
+            if styles:
+                r_face['ls'] = styles
+            r_faces.append(r_face)
 
     #print len(_vertex_cache)
-    return {
+    result = {
         'frames': [{'a': [{'v': r_vertices, 'n': r_normals}]}],
         'uvs': r_uvs,
         'faces': r_faces,
         }
+    if face_lightmaps:
+        result['lightmap_uvs'] = r_lightmap_uvs
+    return add_index_buffers(result)
 
 def triangulate(vlist):
     # This logic is for the client, where the sky is typically rendered
@@ -247,54 +731,100 @@ def explode_into_smaller_faces(vlist, vlistlist):
         vlistlist.append(vlist)
 
 
-def load_bsp_tree(bsp, node_id):
-    result_nodes = []
-    d_leafs = {}
-
-    class frozendict(dict):
-        def __hash__(self):
-            return hash(tuple(self.items()))
-
-    d_leafs[frozendict(type=-2)] = 0
+LEAF_SOUNDS = ('sndwater', 'sndsky', 'sndslime', 'sndlava')
 
-    def _load_bsp_node(node_id):
+def load_bsp_tree(bsp, node_id):
+    # The BSP tree for point-contents queries, with the nodes whose two
+    # sides are equal optimized away and the leafs with the same content
+    # and ambient sounds merged.  Returns flat lists:
+    #
+    #   'normals', 'dists'  the plane of each node
+    #   'front', 'back'     children: ~n for the node n, or else a leaf
+    #   'root'              the root, in the same format
+    #   'contents'          the CONTENTS_xxx of each leaf; leaf 0 is solid
+    #   'ambient'           the 4 LEAF_SOUNDS levels of each leaf
+    #
+    # The nodes are numbered in post-order, so the root is the last one.
+    # This is a loop with an explicit stack instead of a recursion.  It
+    # reads the lumps as plain lists of columns, not record by record.
+    node_planes, node_fronts, node_backs = bsp.nodes.get_columns(
+        ('plane_id', 'front', 'back'))
+    leaf_keys_by_id = zip(*bsp.leafs.get_columns(('type',) + LEAF_SOUNDS))
+    plane_normals, plane_dists = bsp.planes.get_columns(('normal', 'dist'))
+    r_normals = []
+    r_dists = []
+    r_front = []
+    r_back = []
+    leaf_keys = {(-2, 0, 0, 0, 0): 0}
+    r_contents = [-2]
+    r_ambient = [0, 0, 0, 0]
+
+    results = []
+    pending = [(node_id, False)]
+    while pending:
+        node_id, children_done = pending.pop()
         if node_id == 0xffff:
-            return 0
-        if node_id & 0x8000:
-            leaf = bsp.leafs[node_id ^ 0xffff]
-            assert leaf.type < 0
-            result = frozendict()
-            result['type'] = leaf.type
-            for name in ('sndwater', 'sndsky', 'sndslime', 'sndlava'):
-                if getattr(leaf, name) != 0:
-                    result[name] = getattr(leaf, name)
-            return d_leafs.setdefault(result, len(d_leafs))
+            results.append(0)
+        elif node_id & 0x8000:
+            key = leaf_keys_by_id[node_id ^ 0xffff]
+            assert key[0] < 0
+            if key not in leaf_keys:
+                leaf_keys[key] = len(r_contents)
+                r_contents.append(key[0])
+                r_ambient.extend(key[1:])
+            results.append(leaf_keys[key])
+        elif not children_done:
+            pending.append((node_id, True))
+            pending.append((node_backs[node_id], False))
+            pending.append((node_fronts[node_id], False))    # done first
         else:
-            result = {}
-            node = bsp.nodes[node_id]
-            tree_front = _load_bsp_node(node.front)
-            if tree_front != 0:
-                result['front'] = tree_front
-            #
-            tree_back = _load_bsp_node(node.back)
-            if tree_back != 0:
-                result['back'] = tree_back
-            #
+            tree_back = results.pop()
+            tree_front = results.pop()
             if tree_front == tree_back:     # equal (possibly both are 0)
-                return tree_front      # optimized away
-            plane = bsp.planes[node.plane_id]
-            p = map_vertex(plane.normal)
-            p['w'] = plane.dist
-            result['plane'] = p
-            index = len(result_nodes)
-            result_nodes.append(result)
-            return ~index
-
-    _load_bsp_node(node_id)
-    result_leafs = [None] * len(d_leafs)
-    for key, value in d_leafs.iteritems():
-        assert value >= 0
-        result_leafs[value] = key
+                results.append(tree_front)      # optimized away
+                continue
+            plane_id = node_planes[node_id]
+            results.append(~len(r_front))
+            r_normals.append(map_vertex(plane_normals[plane_id]))
+            r_dists.append(plane_dists[plane_id])
+            r_front.append(tree_front)
+            r_back.append(tree_back)
+    [root] = results
+
+    return {
+        'normals': r_normals,
+        'dists': r_dists,
+        'front': r_front,
+        'back': r_back,
+        'root': root,
+        'contents': r_contents,
+        'ambient': r_ambient,
+        }
+
+def get_bsp_tree_nodes(bsptree):
+    # the tree from load_bsp_tree() as lists of dicts, the format of
+    # 'bspnodes' and 'bspleafs'
+    result_nodes = []
+    for normal, dist, front, back in zip(bsptree['normals'],
+                                         bsptree['dists'],
+                                         bsptree['front'], bsptree['back']):
+        result = {}
+        if front != 0:
+            result['front'] = front
+        if back != 0:
+            result['back'] = back
+        p = dict(normal)
+        p['w'] = dist
+        result['plane'] = p
+        result_nodes.append(result)
+    result_leafs = []
+    ambient = bsptree['ambient']
+    for i, contents in enumerate(bsptree['contents']):
+        result = {'type': contents}
+        for name, level in zip(LEAF_SOUNDS, ambient[i * 4 : i * 4 + 4]):
+            if level != 0:
+                result[name] = level
+        result_leafs.append(result)
     return result_nodes, result_leafs
 
 
@@ -303,12 +833,23 @@ def load_texture(mipmap):
     return {'width': mipmap.w, 'height': mipmap.h, 'data': r_data}
 
 
-def load_model(modelname):
+def load_model(modelname, use_atlas=False, compact=False):
+    # With 'compact=True', the frames of a .mdl are not expanded into
+    # lists of vertices and normals.  Instead, each frame has:
+    #
+    #   'trivertx': base64 of 4 bytes per vertex, (x, y, z, normal)
+    #   'bboxmin', 'bboxmax': the bounding box of the frame
+    #
+    # The position is 'scale_origin' + 'scale' * (x, y, z), component by
+    # component (all already with y and z swapped, like map_vertex()),
+    # and the normal is the index into the list 'normals'.
     assert modelname.endswith('.mdl') or modelname.endswith('.bsp')
     mdl = CONTENT[modelname]
     if isinstance(mdl, qdata.QBsp):
         result = load_bsp_model(mdl, mdl.models[0])
         result['skins'] = load_bsp_textures(mdl)
+        if use_atlas:
+            result['atlas_pages'] = load_texture_atlas(mdl, result['skins'])
         return result
 
     i_width = 1.0 / mdl.skinwidth
@@ -338,14 +879,56 @@ def load_model(modelname):
         r_faces.append({'v': r_v, 't': 0})
 
     r_frames = []
+    r_all_normals = [map_vertex(normal) for normal in mdl.Normals]
+    r_scale = map_vertex(mdl.scale)
+    r_scale_origin = map_vertex(mdl.scale_origin)
+
+    def get_compact_frame(frame, time=1):
+        if not compressed:
+            # no triangles, so no vertices: a zero bounding box
+            bboxmin = bboxmax = [0, 0, 0]
+            data = ''
+        elif isinstance(frame, qdata.QArrayFrame):
+            trivertx = mdl.trivertx[frame.pose][compressed]
+            trivertx = trivertx[:, [0, 2, 1, 3]]
+            bboxmin = trivertx[:, :3].min(axis=0).tolist()
+            bboxmax = trivertx[:, :3].max(axis=0).tolist()
+            data = trivertx.tostring()
+        else:
+            trivertx = []
+            for mdl_vindex in compressed:
+                x, y, z, n = frame.v[mdl_vindex]
+                x = int(round((x - mdl.scale_origin[0]) / mdl.scale[0]))
+                y = int(round((y - mdl.scale_origin[1]) / mdl.scale[1]))
+                z = int(round((z - mdl.scale_origin[2]) / mdl.scale[2]))
+                trivertx.append((x, z, y, n))
+            bboxmin = [min(column) for column in zip(*trivertx)[:3]]
+            bboxmax = [max(column) for column in zip(*trivertx)[:3]]
+            data = str(bytearray([c for v in trivertx for c in v]))
+        def dequantize(v):
+            return {'x': r_scale_origin['x'] + r_scale['x'] * v[0],
+                    'y': r_scale_origin['y'] + r_scale['y'] * v[1],
+                    'z': r_scale_origin['z'] + r_scale['z'] * v[2]}
+        return {'trivertx': data.encode('base64'),
+                'bboxmin': dequantize(bboxmin),
+                'bboxmax': dequantize(bboxmax),
+                'time': time}
 
     def get_frame(frame, time=1):
+        if compact:
+            return get_compact_frame(frame, time)
+        if isinstance(frame, qdata.QArrayFrame):
+            positions = mdl.positions[frame.pose][compressed].tolist()
+            normals = mdl.trivertx[frame.pose, compressed, 3].tolist()
+            r_vertices = map(map_vertex, positions)
+            r_normals = [r_all_normals[n] for n in normals]
+            return {'v': r_vertices, 'n': r_normals, 'time': time}
         r_vertices = []
         r_normals = []
         for mdl_vindex in compressed:
             x, y, z, n = frame.v[mdl_vindex]
             r_vertices.append(map_vertex((x, y, z)))
-            r_normals.append(map_vertex(mdl.Normals[n]))
+            r_normals.append(r_all_normals[n])
         return {'v': r_vertices, 'n': r_normals, 'time': time}
 
     for frame_or_group in mdl.frames:
@@ -363,13 +946,18 @@ def load_model(modelname):
         assert skin.h == mdl.skinheight
         r_skins.append(load_texture(skin))
 
-    return {
+    result = {
         'frames': r_frames,
         'uvs': r_uvs,
         'faces': r_faces,
         'skins': r_skins,
         'flags': mdl.flags,  # EF_xxx flags from src/model.h (not src/server.h!)
         }
+    if compact:
+        result['scale'] = r_scale
+        result['scale_origin'] = r_scale_origin
+        result['normals'] = r_all_normals
+    return add_index_buffers(result)
 
 
 if __name__ == '__main__':
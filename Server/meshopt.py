@@ -0,0 +1,125 @@
+# Triangle index buffers for the models of maploader: the polygons are
+# fan-triangulated and grouped by material, the triangles of each group
+# are reordered for the post-transform vertex cache of the GPU, and the
+# vertices are renumbered in order of first use, for locality of the
+# vertex fetches.
+
+
+CACHE_SIZE = 16
+
+
+def fan_triangulate(vlist):
+    # like the client did: (v0, v1, v2), (v0, v2, v3), ...
+    result = []
+    v0 = vlist[0]
+    for i in range(1, len(vlist) - 1):
+        result += (v0, vlist[i], vlist[i + 1])
+    return result
+
+
+def optimize_vertex_cache(indices, cache_size=CACHE_SIZE):
+    # The "Tipsify" algorithm from Sander, Nehab and Barczak, "Fast
+    # Triangle Reordering for Vertex Locality and Reduced Overdraw"
+    # (SIGGRAPH 2007).  Takes and returns a flat list of triangle
+    # indices.  Linear time; the vertex numbers can be anything.
+    local = {}
+    vertices = []
+    tris = []
+    for v in indices:
+        try:
+            tris.append(local[v])
+        except KeyError:
+            local[v] = len(vertices)
+            tris.append(len(vertices))
+            vertices.append(v)
+    num_vertices = len(vertices)
+    num_tris = len(tris) // 3
+
+    tris_of = [[] for v in range(num_vertices)]
+    for t in range(num_tris):
+        for v in tris[t * 3 : t * 3 + 3]:
+            tris_of[v].append(t)
+    live = [len(l) for l in tris_of]
+    timestamps = [-cache_size - 1] * num_vertices
+    emitted = [False] * num_tris
+    dead_end = []
+    time = 0
+    cursor = 0
+    output = []
+    fanning = 0 if num_tris else -1
+    while fanning >= 0:
+        candidates = []
+        for t in tris_of[fanning]:
+            if emitted[t]:
+                continue
+            emitted[t] = True
+            for v in tris[t * 3 : t * 3 + 3]:
+                output.append(v)
+                dead_end.append(v)
+                candidates.append(v)
+                live[v] -= 1
+                if time - timestamps[v] > cache_size:
+                    timestamps[v] = time
+                    time += 1
+        # the next vertex to fan around: one that is still in the cache
+        # after emitting all its triangles, the oldest one if possible
+        fanning = -1
+        best_priority = -1
+        for v in candidates:
+            if live[v] > 0:
+                priority = 0
+                if time - timestamps[v] + 2 * live[v] <= cache_size:
+                    priority = time - timestamps[v]
+                if priority > best_priority:
+                    best_priority = priority
+                    fanning = v
+        if fanning < 0:
+            while dead_end:
+                v = dead_end.pop()
+                if live[v] > 0:
+                    fanning = v
+                    break
+            else:
+                while cursor < num_vertices and live[cursor] == 0:
+                    cursor += 1
+                if cursor < num_vertices:
+                    fanning = cursor
+    return [vertices[v] for v in output]
+
+
+def build_index_buffers(faces, num_vertices):
+    # 'faces' is the list of {'v': [polygon], 't': texid, maybe 'ls'}.
+    # Returns (submeshes, order): 'submeshes' is a list of {'t', maybe
+    # 'ls', 'triangles'}, one per material in order; 'order' lists the
+    # old vertex numbers in the new order of the vertices, which is the
+    # order of first use in the submeshes.  The 'triangles' use the new
+    # vertex numbers, and the 'faces' are changed in-place to use them
+    # too.
+    groups = {}
+    for face in faces:
+        if len(face['v']) < 3:
+            continue
+        key = (face['t'], tuple(face.get('ls', ())))
+        groups.setdefault(key, []).extend(fan_triangulate(face['v']))
+
+    renumber = [-1] * num_vertices
+    order = []
+    submeshes = []
+    for key in sorted(groups):
+        triangles = optimize_vertex_cache(groups[key])
+        for i, v in enumerate(triangles):
+            if renumber[v] < 0:
+                renumber[v] = len(order)
+                order.append(v)
+            triangles[i] = renumber[v]
+        submesh = {'t': key[0], 'triangles': triangles}
+        if key[1]:
+            submesh['ls'] = list(key[1])
+        submeshes.append(submesh)
+    for v in range(num_vertices):
+        if renumber[v] < 0:     # not used by any face
+            renumber[v] = len(order)
+            order.append(v)
+    for face in faces:
+        face['v'] = [renumber[v] for v in face['v']]
+    return submeshes, order
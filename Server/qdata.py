@@ -1,9 +1,14 @@
-import struct, os
+import struct, os, mmap, re
 from cStringIO import StringIO
+try:
+    import numpy
+except ImportError:
+    numpy = None     # only needed for the 'arrays=True' mode
 
 
 class QData(object):
     repr_flag = False
+    arrays = False
 
     def __init__(self, *args, **kwds):
         if args:
@@ -13,18 +18,74 @@ class QData(object):
 
     def __getattr__(self, attr):
         if attr == 'rawdata':
-            try:
+            if hasattr(self, '_rawdata') and not self._partially_decoded():
                 return self._rawdata
-            except AttributeError:
-                f = StringIO()
-                self.pack(f)
-                return f.getvalue()
+            f = StringIO()
+            self.pack(f)
+            return f.getvalue()
         if attr.startswith('_') or not hasattr(self, '_rawdata'):
             raise AttributeError, attr
-        self.unpack(StringIO(self._rawdata), *self._args)
-        del self._rawdata
+        layout = self._get_lazy_layout()
+        if layout is None:
+            self.unpack(StringIO(self._rawdata), *self._args)
+            del self._rawdata
+        else:
+            self._unpack_lazy(layout, attr)
         return getattr(self, attr)
 
+    # Lazy decoding: if the class uses the default unpack() and the
+    # offset of every field is known in advance, then the fields are
+    # decoded only when accessed.  All the small fields (the "header")
+    # are decoded together; the others (lumps, arrays) one by one.
+
+    def _get_lazy_layout(cls):
+        try:
+            return cls.__dict__['_lazy_layout']
+        except KeyError:
+            pass
+        layout = None
+        if (cls.unpack.im_func is QData.unpack.im_func and
+                hasattr(cls, 'FIELDS')):
+            layout = {}
+            ofs = 0
+            for name, fld in cls.FIELDS:
+                if ofs is None:
+                    layout = None
+                    break
+                layout[name] = (fld, ofs)
+                size = getattr(fld, 'size', None)
+                ofs = ofs + size if size is not None else None
+        cls._lazy_layout = layout
+        return layout
+    _get_lazy_layout = classmethod(_get_lazy_layout)
+
+    def _unpack_lazy(self, layout, attr):
+        # decode the header (which checks the signature) and 'attr',
+        # or everything if 'attr' is not a field
+        f = StringIO(self._rawdata)
+        names = [name for name, fld in self.__class__.FIELDS
+                 if name == attr or attr not in layout
+                                 or not getattr(fld, 'lazy', False)]
+        for name in names:
+            if name not in self.__dict__:
+                fld, ofs = layout[name]
+                f.seek(ofs)
+                setattr(self, name, fld.read(f, self))
+        for name in layout:
+            if name not in self.__dict__:
+                break
+        else:
+            del self._rawdata
+
+    def _partially_decoded(self):
+        layout = self._get_lazy_layout()
+        if layout is None:
+            return False
+        for name in layout:
+            if name in self.__dict__:
+                return True
+        return False
+
     def __repr__(self):
         # hack!
         if not QData.repr_flag:
@@ -37,7 +98,8 @@ class QData(object):
                 keys = self.__dict__.keys()
                 keys.sort()
                 for name in keys:
-                    if not name.startswith('_') and name not in items:
+                    if (not name.startswith('_') and name not in items and
+                            name != 'arrays'):
                         items.append(name)
                 dpy = []
                 for name in items:
@@ -94,6 +156,7 @@ class FSignature:
         if isinstance(expected, int):
             expected = struct.pack("<i", expected)
         self.expected = expected
+        self.size = len(expected)
     def read(self, f, ctx):
         sig = f.read(len(self.expected))
         assert sig == self.expected, "bad signature: %r instead of %r" % (
@@ -104,6 +167,8 @@ class FSignature:
         f.write(sig)
 
 class FLump:
+    size = 8
+    lazy = True
     def __init__(self, lumpcls, align=4):
         self.lumpcls = lumpcls
         self.align = align
@@ -114,7 +179,7 @@ class FLump:
         data = f.read(size)
         f.seek(cur)
         assert len(data) == size, "premature end of file"
-        return self.lumpcls(data, ctx)
+        return self.lumpcls(data, ctx, arrays=ctx.arrays)
     def write(self, f, lump):
         data = lump.rawdata
         p = f.tell()
@@ -129,9 +194,12 @@ class FLump:
         return patch
 
 class FOfsArray:
+    lazy = True
     def __init__(self, itemcls, fixedlength=None):
         self.itemcls = itemcls
         self.fixedlength = fixedlength
+        if fixedlength is not None:
+            self.size = 4 * fixedlength
     def read(self, f, ctx):
         result = []
         count = self.fixedlength
@@ -164,8 +232,25 @@ class FOfsArray:
         f.seek(endpos)
 
 class FArray:
+    lazy = True
     def __init__(self, itemcls):
         self.itemcls = itemcls
+        dtypes = [getattr(fld, 'dtype', None)
+                  for name, fld in itemcls.FIELDS]
+        if None in dtypes:
+            self.dtype = None
+        else:
+            self.dtype = [(name, dt) for (name, fld), dt in
+                                         zip(itemcls.FIELDS, dtypes)]
+    def unarray(self, record):
+        kwds = {}
+        for (name, fld), x in zip(self.itemcls.FIELDS, record.item()):
+            if isinstance(x, numpy.ndarray):
+                x = x.tolist()
+            if hasattr(fld, 'unarray'):
+                x = fld.unarray(x)
+            kwds[name] = x
+        return self.itemcls(**kwds)
     def read(self, f, ctx):
         result = []
         p = f.tell()
@@ -182,8 +267,15 @@ class FArray:
             x.pack(f)
 
 class FArrayOf:
+    lazy = True
     def __init__(self, fitem):
         self.fitem = fitem
+        self.dtype = getattr(fitem, 'dtype', None)
+    def unarray(self, x):
+        x = x.tolist()
+        if hasattr(self.fitem, 'unarray'):
+            x = self.fitem.unarray(x)
+        return x
     def read(self, f, ctx):
         result = []
         p = f.tell()
@@ -193,24 +285,28 @@ class FArrayOf:
         while f.tell() < end:
             result.append(self.fitem.read(f, ctx))
         return result
-##    def write(self, f, value):
-##        for x in value:
-##            self.fitem.write(f, x)
+    def write(self, f, value):
+        for x in value:
+            self.fitem.write(f, x)
 
 class FCharPtr:
     def __init__(self, size):
         self.size = size
-    def read(self, f, ctx):
-        data = f.read(self.size)
+        self.dtype = "S%d" % size
+    def unarray(self, data):
         i = data.find('\x00')
         if i >= 0:
             data = data[:i]
         return data
+    def read(self, f, ctx):
+        return self.unarray(f.read(self.size))
     def write(self, f, data):
         assert len(data) < self.size
         f.write(data + '\x00' * (self.size - len(data)))
 
 class FInt:
+    size = 4
+    dtype = "<i4"
     def read(self, f, ctx):
         x, = struct.unpack("<i", f.read(4))
         return x
@@ -218,6 +314,7 @@ class FInt:
         f.write(struct.pack("<i", x))
 
 class FInt3b:
+    size = 3
     def read(self, f, ctx):
         x, = struct.unpack("<i", f.read(3) + '\x00')
         return x
@@ -225,6 +322,8 @@ class FInt3b:
         f.write(struct.pack("<i", x)[:3])
 
 class FInt2b:
+    size = 2
+    dtype = "<i2"
     def read(self, f, ctx):
         x, = struct.unpack("<h", f.read(2))
         return x
@@ -232,6 +331,8 @@ class FInt2b:
         f.write(struct.pack("<h", x))
 
 class FInt1b:
+    size = 1
+    dtype = "i1"
     def read(self, f, ctx):
         x, = struct.unpack("<b", f.read(1))
         return x
@@ -239,6 +340,8 @@ class FInt1b:
         f.write(struct.pack("<b", x))
 
 class FUShort:
+    size = 2
+    dtype = "<u2"
     def read(self, f, ctx):
         x, = struct.unpack("<H", f.read(2))
         return x
@@ -246,6 +349,8 @@ class FUShort:
         f.write(struct.pack("<H", x))
 
 class FUChar:
+    size = 1
+    dtype = "u1"
     def read(self, f, ctx):
         x, = struct.unpack("<B", f.read(1))
         return x
@@ -253,6 +358,8 @@ class FUChar:
         f.write(struct.pack("<B", x))
 
 class FFloat:
+    size = 4
+    dtype = "<f4"
     def read(self, f, ctx):
         x, = struct.unpack("<f", f.read(4))
         return x
@@ -260,18 +367,27 @@ class FFloat:
         f.write(struct.pack("<f", x))
 
 class FVec3:
+    size = 12
+    dtype = ("<f4", (3,))
+    def unarray(self, x):
+        return tuple(x)
     def read(self, f, ctx):
         return struct.unpack("<fff", f.read(12))
     def write(self, f, (x, y, z)):
         f.write(struct.pack("<fff", x, y, z))
 
 class FVec4:
+    size = 16
+    dtype = ("<f4", (4,))
+    def unarray(self, x):
+        return tuple(x)
     def read(self, f, ctx):
         return struct.unpack("<ffff", f.read(16))
     def write(self, f, (x, y, z, ofs)):
         f.write(struct.pack("<ffff", x, y, z, ofs))
 
 class FEnum:
+    size = 4
     def __init__(self, choices):
         self.choices = choices
     def read(self, f, ctx):
@@ -297,6 +413,62 @@ class FEnum:
 # ____________________________________________________________
 
 
+class QRecordList(object):
+    """Compatibility view over a numpy structured array: behaves like
+    the list of QData objects that FArray or FArrayOf would have built,
+    but only creates the items when they are accessed.
+    """
+    def __init__(self, array, farray):
+        self.array = array
+        self.farray = farray
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return QRecordList(self.array[index], self.farray)
+        return self.farray.unarray(self.array[index])
+
+    def __iter__(self):
+        unarray = self.farray.unarray
+        for x in self.array:
+            yield unarray(x)
+
+
+class QArrayLump(QData):
+    """A lump made of a single 'list' field of fixed-size records.
+    With 'arrays=True', the records are not decoded one by one:
+    'self.array' is a numpy structured array sharing the raw bytes,
+    and 'self.list' is a QRecordList on top of it.
+    """
+
+    def unpack(self, f, *ignored):
+        [(name, fld)] = self.__class__.FIELDS
+        if self.arrays and numpy is not None and fld.dtype is not None:
+            self.array = numpy.frombuffer(self._rawdata,
+                                          numpy.dtype(fld.dtype))
+            setattr(self, name, QRecordList(self.array, fld))
+        else:
+            QData.unpack(self, f)
+
+    def pack(self, f):
+        if 'array' in self.__dict__:
+            f.write(self.array.tostring())
+        else:
+            QData.pack(self, f)
+
+    def get_columns(self, names):
+        # the fields 'names' of all the records, as one plain list each;
+        # with arrays, they come directly from the columns of 'self.array'
+        # instead of going through the records
+        [(name, fld)] = self.__class__.FIELDS
+        records = getattr(self, name)
+        if 'array' in self.__dict__:
+            return [self.array[n].tolist() for n in names]
+        return [[getattr(record, n) for record in records] for n in names]
+
+
 class QMipmap(QData):
     def unpack(self, f, texture, index):
         data = f.read()
@@ -350,7 +522,7 @@ class QTexinfo(QData):
         ('flags',   FInt()),
         ]
 
-class QTexinfos(QData):
+class QTexinfos(QArrayLump):
     FIELDS = [
         ('list', FArray(QTexinfo)),
         ]
@@ -369,7 +541,7 @@ class QBspFace(QData):
         ('lightmap', FInt()),
         ]
 
-class QBspFaces(QData):
+class QBspFaces(QArrayLump):
     FIELDS = [
         ('list', FArray(QBspFace)),
         ]
@@ -380,7 +552,7 @@ class QBspEdge(QData):
         ('vertex1', FUShort()),
         ]
 
-class QBspEdges(QData):
+class QBspEdges(QArrayLump):
     FIELDS = [
         ('list', FArray(QBspEdge)),
         ]
@@ -399,7 +571,7 @@ class QBspModel(QData):
         ('face_num', FInt()),
         ]
 
-class QBspModels(QData):
+class QBspModels(QArrayLump):
     FIELDS = [
         ('list', FArray(QBspModel)),
         ]
@@ -411,7 +583,7 @@ class QPlane(QData):
         ('type', FInt()),
         ]
 
-class QPlanes(QData):
+class QPlanes(QArrayLump):
     FIELDS = [
         ('list', FArray(QPlane)),
         ]
@@ -426,7 +598,7 @@ class QNode(QData):
         ('face_num', FUShort()),
         ]
 
-class QNodes(QData):
+class QNodes(QArrayLump):
     FIELDS = [
         ('list', FArray(QNode)),
         ]
@@ -444,30 +616,59 @@ class QLeaf(QData):
         ('sndlava', FUChar()),
         ]
 
-class QLeafs(QData):
+class QLeafs(QArrayLump):
     FIELDS = [
         ('list', FArray(QLeaf)),
         ]
 
-class QLFaces(QData):
+class QLFaces(QArrayLump):
     FIELDS = [
         ('list', FArrayOf(FUShort())),
         ]
 
-class QListOfInt(QData):
+class QListOfInt(QArrayLump):
     FIELDS = [
         ('list', FArrayOf(FInt())),
         ]
 
-class QListOfVec3(QData):
+class QListOfVec3(QArrayLump):
     FIELDS = [
         ('list', FArrayOf(FVec3())),
         ]
 
+class QEntities(QData):
+    # The entities lump, parsed into 'self.list', a list of dicts.  It
+    # is also indexed by 'classname' and 'targetname': the dicts
+    # 'self.by_classname' and 'self.by_targetname' map names to the
+    # list of entities that have it, in lump order.
+
+    def unpack(self, f, *ignored):
+        self.list = list(parse_entities(f.read()))
+        self.by_classname = {}
+        self.by_targetname = {}
+        for entity in self.list:
+            if 'classname' in entity:
+                self.by_classname.setdefault(entity['classname'],
+                                             []).append(entity)
+            if 'targetname' in entity:
+                self.by_targetname.setdefault(entity['targetname'],
+                                              []).append(entity)
+
+    def pack(self, f):
+        for entity in self.list:
+            f.write('{\n')
+            for key, value in sorted(entity.items()):
+                # like in Quake's COM_Parse(), there are no escapes
+                assert '"' not in key and '"' not in value, (
+                    "'\"' in an entity: %r %r" % (key, value))
+                f.write('"%s" "%s"\n' % (key, value))
+            f.write('}\n')
+        f.write('\x00')
+
 class QBsp(QData):
     FIELDS = [
         ('signature', FSignature(29)),
-        ('entities',  FLump(QData)),
+        ('entities',  FLump(QEntities)),
         ('planes',  FLump(QPlanes)),
         ('textures',  FLump(QTextures)),
         ('vertexes',  FLump(QListOfVec3)),
@@ -489,6 +690,24 @@ class QFrame:
         self.name = name
         self.v = v
 
+class QArrayFrame(QFrame):
+    # a frame of a QMdl decoded with 'arrays=True'.  The vertices are
+    # in 'mdl.trivertx[self.pose]' and 'mdl.positions[self.pose]'; the
+    # list 'self.v' is only built if needed.
+    def __init__(self, name, mdl, pose):
+        self.name = name
+        self.mdl = mdl
+        self.pose = pose
+
+    def __getattr__(self, attr):
+        if attr == 'v':
+            positions = self.mdl.positions[self.pose].tolist()
+            normals = self.mdl.trivertx[self.pose, :, 3].tolist()
+            self.v = [(x, y, z, l) for (x, y, z), l in zip(positions,
+                                                           normals)]
+            return self.v
+        raise AttributeError(attr)
+
 class QFrameGroup:
     def __init__(self, times, frames):
         self.times = times
@@ -684,8 +903,33 @@ class QMdl(QData):
         return min(choices)[1]
     BestNormal = classmethod(BestNormal)
 
+    def BestNormals(cls, normals):
+        # same as BestNormal(), for a whole (..., 3) array of vectors
+        # at once.  Returns an array of indices into 'Normals'.
+        table = cls.get_normals_array()
+        normals = numpy.asarray(normals, float)
+        flat = normals.reshape(-1, 3)
+        result = numpy.empty(len(flat), 'u1')
+        CHUNK = 4096     # limits the temporary (CHUNK, 162, 3) array
+        for i in range(0, len(flat), CHUNK):
+            delta = flat[i:i+CHUNK, None, :] - table[None, :, :]
+            result[i:i+CHUNK] = (delta * delta).sum(axis=2).argmin(axis=1)
+        return result.reshape(normals.shape[:-1])
+    BestNormals = classmethod(BestNormals)
+
+    def get_normals_array(cls):
+        try:
+            return cls.__dict__['_normals_array']
+        except KeyError:
+            cls._normals_array = numpy.array(cls.Normals, float)
+            return cls._normals_array
+    get_normals_array = classmethod(get_normals_array)
+
     def unpack(self, f):
         QData.unpack(self, f)
+        if self.arrays and numpy is not None:
+            self.unpack_arrays(f)
+            return
         self.skins = []
         for i in range(self.numskins_):
             skintype = f.read(4)
@@ -727,11 +971,93 @@ class QMdl(QData):
                 frame_or_group = QFrameGroup(times, frames)
             self.frames.append(frame_or_group)
 
-    def fix(self):
-        allv = []
-        for frame in self.frames:
-            allv += frame.v
-        bboxmin, bboxmax = getbbox(allv)
+    def unpack_arrays(self, f):
+        # Same as unpack(), but decodes everything into numpy arrays:
+        #
+        #   self.skin_array   (numskins, skinheight, skinwidth) uint8
+        #   self.st_array     records (onseam, s, t)
+        #   self.tri_array    records (front, v[3])
+        #   self.trivertx     (numposes, numverts, 4) uint8
+        #   self.positions    (numposes, numverts, 3) float, i.e. the
+        #                     trivertx scaled by 'scale' and 'scale_origin'
+        #
+        # where 'poses' are all frames, with the frame groups flattened.
+        # The lists 'skins', 'vertices', 'triangles' and 'frames' are
+        # still built, but the frames contain QArrayFrame objects.
+        rawdata = self._rawdata
+        def read_array(dtype, count):
+            dtype = numpy.dtype(dtype)
+            ofs = f.tell()
+            f.seek(ofs + dtype.itemsize * count)
+            return numpy.frombuffer(rawdata, dtype, count, ofs)
+
+        skins = read_array([('type', '<i4'),
+                            ('data', 'u1', (self.skinheight,
+                                            self.skinwidth))],
+                           self.numskins_)
+        assert (skins['type'] == 0).all()
+        self.skin_array = skins['data']
+        self.skins = [QMipmap(w=self.skinwidth, h=self.skinheight,
+                              data=skin.tostring())
+                      for skin in self.skin_array]
+
+        self.st_array = read_array([('onseam', '<i4'),
+                                    ('s', '<i4'),
+                                    ('t', '<i4')], self.numverts_)
+        self.vertices = zip(self.st_array['s'].tolist(),
+                            self.st_array['t'].tolist(),
+                            ((self.st_array['onseam'] & 0x20) != 0).tolist())
+
+        self.tri_array = read_array([('front', '<i4'),
+                                     ('v', '<i4', (3,))], self.numtris_)
+        self.triangles = [(p1, p2, p3, bool(front)) for front, (p1, p2, p3)
+                          in zip(self.tri_array['front'].tolist(),
+                                 self.tri_array['v'].tolist())]
+
+        frame_dtype = [('bboxmin', 'u1', (4,)),
+                       ('bboxmax', 'u1', (4,)),
+                       ('name', 'S16'),
+                       ('v', 'u1', (self.numverts_, 4))]
+        poses = []
+        def read_frame():
+            [frame] = read_array(frame_dtype, 1)
+            poses.append(frame['v'])
+            name = FCharPtr(16).unarray(frame['name'])
+            return QArrayFrame(name, self, len(poses) - 1)
+
+        self.frames = []
+        for i in range(self.numframes_):
+            frametype, = struct.unpack("<i", f.read(4))
+            if frametype == 0:
+                frame_or_group = read_frame()
+            else:
+                nb, = struct.unpack("<i", f.read(4))
+                f.read(8)   # ignore global bboxmin, bboxmax
+                times = read_array('<f4', nb).tolist()
+                frames = [read_frame() for t in range(nb)]
+                frame_or_group = QFrameGroup(times, frames)
+            self.frames.append(frame_or_group)
+
+        if poses:
+            self.trivertx = numpy.array(poses)
+        else:
+            self.trivertx = numpy.zeros((0, self.numverts_, 4), 'u1')
+        self.positions = (self.trivertx[:, :, :3] * numpy.array(self.scale)
+                          + numpy.array(self.scale_origin))
+
+    def fix(self, bbox=None):
+        if bbox is None:
+            allv = []
+            for frame in self.frames:
+                allv += frame.v
+            if allv:
+                bbox = getbbox(allv)
+            else:
+                # no frames or no vertices: keep the current scale
+                bboxmin = tuple(self.scale_origin)
+                bbox = (bboxmin, tuple([lo + 255.0 * scale for lo, scale in
+                                        zip(bboxmin, self.scale)]))
+        bboxmin, bboxmax = bbox
         self.scale = ((bboxmax[0] - bboxmin[0]) / 255.0,
                       (bboxmax[1] - bboxmin[1]) / 255.0,
                       (bboxmax[2] - bboxmin[2]) / 255.0)
@@ -742,18 +1068,23 @@ class QMdl(QData):
         self.numtris_ = len(self.triangles)
         self.numframes_ = len(self.frames)
 
+    def set_poses(self, positions, normals):
+        # Replace the vertices of all poses (i.e. all frames, with the
+        # frame groups flattened): 'positions' and 'normals' are arrays
+        # of shape (numposes, numverts, 3).  The normals are mapped to
+        # the closest entry in 'Normals'.  The 'frames' list must then
+        # be made of QArrayFrame objects.
+        self.positions = numpy.asarray(positions, float)
+        self.trivertx = numpy.zeros(self.positions.shape[:2] + (4,), 'u1')
+        self.trivertx[:, :, 3] = self.BestNormals(normals)
+
     def pack(self, f):
+        if numpy is not None:
+            self.pack_arrays(f)
+            return
         self.fix()
         QData.pack(self, f)
-        for skin in self.skins:
-            f.write('\x00'*4)
-            assert skin.w == self.skinwidth
-            assert skin.h == self.skinheight
-            skin.pack(f)
-        for s, t, onseam in self.vertices:
-            f.write(struct.pack("<iii", onseam and 0x20 or 0, s, t))
-        for p1, p2, p3, front in self.triangles:
-            f.write(struct.pack("<iiii", front, p1, p2, p3))
+        self.pack_skins_and_triangles(f)
         def packv((x, y, z, l)):
             x = int((x - self.scale_origin[0]) / self.scale[0])
             y = int((y - self.scale_origin[1]) / self.scale[1])
@@ -771,6 +1102,86 @@ class QMdl(QData):
             FCharPtr(16).write(f, frame.name)
             f.writelines(map(packv, frame.v))
 
+    def pack_arrays(self, f):
+        # Same as pack(), but quantizes the vertices of all frames at
+        # once.  Also supports frame groups.
+        def get_pose(frame):
+            if (isinstance(frame, QArrayFrame) and frame.mdl is self and
+                    'v' not in frame.__dict__):
+                return (self.positions[frame.pose],
+                        self.trivertx[frame.pose, :, 3])
+            v = numpy.array(frame.v, float).reshape(-1, 4)
+            return v[:, :3], v[:, 3]
+
+        frames = []
+        for frame_or_group in self.frames:
+            if isinstance(frame_or_group, QFrameGroup):
+                frames += frame_or_group.frames
+            else:
+                frames.append(frame_or_group)
+        poses = map(get_pose, frames)
+        if poses:
+            positions = numpy.array([pos for pos, normals in poses], float)
+            normals = numpy.array([normals for pos, normals in poses], 'u1')
+        else:
+            positions = numpy.zeros((0, len(self.vertices), 3))
+            normals = numpy.zeros((0, len(self.vertices)), 'u1')
+        assert positions.shape == (len(frames), len(self.vertices), 3)
+
+        if positions.size:
+            bboxmin = tuple(positions.min(axis=1).min(axis=0).tolist())
+            bboxmax = tuple(positions.max(axis=1).max(axis=0).tolist())
+            self.fix(bbox=(bboxmin, bboxmax))
+        else:
+            self.fix()      # no frames or no vertices, like in pack()
+        scale = numpy.array(self.scale)
+        scale[scale == 0.0] = 1.0    # all vertices have the same coordinate
+        quantized = ((positions - numpy.array(self.scale_origin)) /
+                     scale).astype(int)
+        assert (quantized >= 0).all() and (quantized <= 255).all()
+        trivertx = numpy.empty(positions.shape[:2] + (4,), 'u1')
+        trivertx[:, :, :3] = quantized
+        trivertx[:, :, 3] = normals
+        # per-pose bounding boxes, as trivertx with a 0 normal index
+        bboxes = numpy.zeros((len(frames), 2, 4), 'u1')
+        if len(self.vertices):
+            bboxes[:, 0, :3] = quantized.min(axis=1)
+            bboxes[:, 1, :3] = quantized.max(axis=1)
+
+        QData.pack(self, f)
+        self.pack_skins_and_triangles(f)
+        pose = 0
+        for frame_or_group in self.frames:
+            if isinstance(frame_or_group, QFrameGroup):
+                nb = len(frame_or_group.frames)
+                f.write(struct.pack("<ii", 1, nb))
+                group_bbox = numpy.zeros((2, 4), 'u1')
+                if nb:
+                    group_bbox[0] = bboxes[pose:pose+nb, 0].min(axis=0)
+                    group_bbox[1] = bboxes[pose:pose+nb, 1].max(axis=0)
+                f.write(group_bbox.tostring())
+                f.write(numpy.array(frame_or_group.times, '<f4').tostring())
+                group = frame_or_group.frames
+            else:
+                f.write(struct.pack("<i", 0))
+                group = [frame_or_group]
+            for frame in group:
+                f.write(bboxes[pose].tostring())
+                FCharPtr(16).write(f, frame.name)
+                f.write(trivertx[pose].tostring())
+                pose += 1
+
+    def pack_skins_and_triangles(self, f):
+        for skin in self.skins:
+            f.write('\x00'*4)
+            assert skin.w == self.skinwidth
+            assert skin.h == self.skinheight
+            skin.pack(f)
+        for s, t, onseam in self.vertices:
+            f.write(struct.pack("<iii", onseam and 0x20 or 0, s, t))
+        for p1, p2, p3, front in self.triangles:
+            f.write(struct.pack("<iiii", front, p1, p2, p3))
+
 def getbbox(v):
     xs, ys, zs, ls = zip(*v)
     return ((min(xs), min(ys), min(zs)),
@@ -797,13 +1208,18 @@ class QPak(QData):
         f.seek(dirpos)
         self.content = {}
         entries = [QPakEntry(f.read(64)) for i in range(dirlen)]
+        self.entries = entries
         self._names = [entry.name for entry in entries]
+        # the entries are not copied: they are buffers inside our own
+        # raw data (typically a mmap), decoded only when first accessed
+        rawdata = self._rawdata
         for entry in entries:
             ext = entry.name[entry.name.rfind('.'):]
             cls = GUESS_CLASS.get(ext, QData)
-            f.seek(entry.ofs)
-            data = f.read(entry.size)
-            self.content[entry.name] = cls(data)
+            assert entry.ofs + entry.size <= len(rawdata), (
+                "premature end of file")
+            data = buffer(rawdata, entry.ofs, entry.size)
+            self.content[entry.name] = cls(data, arrays=self.arrays)
     def pack(self, f):
         QData.pack(self, f)
         new = self.content.copy()
@@ -836,32 +1252,71 @@ GUESS_CLASS = {
     '.mdl': QMdl,
     }
 
-def load(filename):
+def load(filename, **kwds):
     ext = filename[filename.rfind('.'):]
     cls = GUESS_CLASS.get(ext, QData)
-    data = file(filename, 'rb').read()
-    return cls(data)
+    data = map_file(filename)
+    return cls(data, **kwds)
+
+def map_file(filename):
+    # returns a read-only mmap of the file, which can be used mostly
+    # like a string; the OS pages in only the parts that we really read
+    f = file(filename, 'rb')
+    try:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
 
+r_entity_token = re.compile(r'''
+    \s+ | //[^\n]*                # whitespace and comments
+  | "([^"]*)"                    # quoted string, without escapes
+  | ([{}])                       # braces
+  | ([^\s{}"]+)                  # unquoted word
+  | (.)                          # anything else is an error
+''', re.VERBOSE | re.DOTALL)
+
+def tokenize_entities(rawdata):
+    # Yields ('{', None), ('}', None) and ('s', string) for each token
+    # of the entities lump.  Like Quake, it doesn't care about newlines.
+    end = rawdata.find('\x00')
+    if end < 0:
+        end = len(rawdata)
+    for match in r_entity_token.finditer(rawdata, 0, end):
+        quoted, brace, word, error = match.groups()
+        if quoted is not None:
+            yield 's', quoted
+        elif brace is not None:
+            yield brace, None
+        elif word is not None:
+            yield 's', word
+        else:
+            assert error is None, "unexpected character in entities: %r" % (
+                rawdata[match.start():match.start()+40],)
 
 def parse_entities(rawdata):
-    import re
-    r_line = re.compile(r'"([a-zA-Z0-9_]+)"\s+"(.+)"$')
     entity = None
-    for line in rawdata.splitlines(False):
-        line = line.strip()
-        if line == '{':
-            assert entity is None
+    key = None
+    for kind, value in tokenize_entities(rawdata):
+        if kind == '{':
+            assert entity is None, "unexpected '{' inside an entity"
             entity = {}
-        elif line == '}':
-            assert entity is not None
+        elif kind == '}':
+            assert entity is not None, "unexpected '}'"
+            assert key is None, "key %r without a value" % (key,)
             yield entity
             entity = None
-        elif line and line != '\x00':
-            match = r_line.match(line)
-            assert match, "unexpected line: %r" % (line,)
-            # XXX doesn't unquote or parse the value string
-            entity[match.group(1)] = match.group(2)
-    assert entity is None
+        else:
+            assert entity is not None, "unexpected %r outside an entity" % (
+                value,)
+            if key is None:
+                key = value
+            else:
+                entity[key] = value
+                key = None
+    assert entity is None, "missing final '}'"
 
 def parse_vec3(string):
     vec3 = string.split()
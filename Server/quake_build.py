@@ -10,6 +10,7 @@ ffibuilder = cffi.FFI()
 ffibuilder.cdef("""
     void PQuake_Ready(int c, char **v);
     void PQuake_Host_Frame(float frame_time);
+    double PQuake_Monotonic_Time(void);
 
     typedef float vec_t;
     typedef vec_t vec3_t[3];
@@ -33,6 +34,7 @@ ffibuilder.cdef("""
 
     typedef struct {
         int num_edicts;
+        double time;
         char *lightstyles[...];
         char *model_precache[...];
         ...;
@@ -80,6 +82,7 @@ ffibuilder.cdef("""
 
     typedef struct client_s
     {
+        qboolean		active;				// false = client is free
         struct qsocket_s *netconnection;	// communications handle
         char			name[32];			// for printing to other people
         ...;
@@ -95,12 +98,13 @@ ffibuilder.cdef("""
     server_static_t	svs;
 
     void SV_ConnectClient(int clientnum);
+    void PQuake_DropClient(int clientnum);
     void PQuake_setorigin(int eindex, float x, float y, float z,
                           qboolean triggers);
     void PQuake_push(int eindex, float dx, float dy, float dz);
 
     extern "Python" {
-        void PQuake_StuffCmd(char *);
+        void PQuake_StuffCmd(int, char *);
     }
 """)
 
@@ -256,6 +260,16 @@ ffibuilder.set_source("_quake", r"""
         Host_Frame(frame_time);
     }
 
+    #include <time.h>
+
+    double PQuake_Monotonic_Time(void)
+    {
+        /* seconds, from a clock that doesn't jump if the date changes */
+        struct timespec ts;
+        clock_gettime(CLOCK_MONOTONIC, &ts);
+        return ts.tv_sec + ts.tv_nsec * 1e-9;
+    }
+
     typedef void (*builtin_t) (void);
     extern	builtin_t *pr_builtins;
     extern int pr_numbuiltins;
@@ -315,7 +329,7 @@ ffibuilder.set_source("_quake", r"""
         PF_makestatic();
     }
 
-    static void PQuake_StuffCmd(char *);   /* extern "Python" */
+    static void PQuake_StuffCmd(int, char *);   /* extern "Python" */
 
     static void PQuake_PF_stuffcmd (void)
     {
@@ -328,7 +342,7 @@ ffibuilder.set_source("_quake", r"""
             PR_RunError ("Parm 0 not a client");
         str = G_STRING(OFS_PARM1);
 
-        PQuake_StuffCmd(str);
+        PQuake_StuffCmd(entnum, str);
     }
 
     static void hack_pr_cmds(void)
@@ -396,6 +410,17 @@ ffibuilder.set_source("_quake", r"""
         SV_PushEntity(e, push);
     }
 
+    void PQuake_DropClient(int clientnum)
+    {
+        host_client = svs.clients + clientnum;
+        /* our qsocket_t don't come from NET_NewQSocket(): mark them as
+           disconnected, so that NET_Close() doesn't try to free them */
+        host_client->netconnection->disconnected = true;
+        /* SV_DropClient() decrements it, but it was not incremented */
+        net_activeconnections++;
+        SV_DropClient(false);
+    }
+
     void PQuake_Cmd_ExecuteString(char *text, cmd_source_t src)
     {
         sv_player = host_client->edict;
@@ -3,7 +3,10 @@ from _quake import lib, ffi
 import time
 import thread
 
+import maploader
 from maploader import map_vertex, map_angles
+from visibility import LevelVisibility
+from snapshots import T_STRING, T_UINT8, T_UINT16, T_ORIGIN, T_ANGLE
 
 
 class Edict(object):
@@ -105,32 +108,80 @@ class StaticEntity(object):
 
 
 @ffi.def_extern()
-def PQuake_StuffCmd(s):
+def PQuake_StuffCmd(entnum, s):
     s = ffi.string(s)
-    print 'stuffcmd:', repr(s)
-    if s == "bf\n":
-        global screen_flash
-        screen_flash = 1
-screen_flash = 0
+    print 'stuffcmd:', entnum, repr(s)
+    if s == "bf\n" and entnum in players_by_entnum:
+        players_by_entnum[entnum].screen_flash = 1
+
+players_by_entnum = {}      # {edict number: Player}
+
+
+class Player(object):
+    # A client connected to the server, in its own svs.clients slot,
+    # with its own edict.
+    def __init__(self, clientnum):
+        self.clientnum = clientnum
+        self.client = lib.svs.clients + clientnum
+        self.ed = Edict(clientnum + 1)
+        self.qsocket = ffi.new("qsocket_t *")
+        self.prev_weapon_pos = (9999, 0, 0)
+        self.screen_flash = 0
+        self.pending_cmds = []
+
+    def __repr__(self):
+        return 'Player(%r)' % (self.clientnum,)
 
 def sqr(x):
     return x * x
 
+
+class Snapshot(list):
+    # The list of values sent to the clients.  'entity_leafs' is a list
+    # of (index, leafs): the index in the list where an entity starts,
+    # and the set of BSP leafs that it touches (see visibility.py), or
+    # None if it should always be sent.  'types' are the types of the
+    # values since the version 5 of the protocol, and 'time' is the
+    # server time since the version 7 (see snapshots.py).  The items
+    # that depend on the player start at 'player_items_index', and
+    # 'player_entries' is {edict number of a player: index of its entry}.
+    entity_leafs = ()
+    types = None
+    time = 0.0
+    player_items_index = 0
+    player_entries = {}
+
+SNAPSHOT_ENTRY_SIZE = 9
+SNAPSHOT_EMPTY_ENTRY = ["", 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
+# model, frame, flags, origin, angles
+SNAPSHOT_ENTRY_TYPES = ([T_STRING, T_UINT8, T_UINT16] + [T_ORIGIN] * 3 +
+                        [T_ANGLE] * 3)
+
+def get_snapshot_types(num_lightstyles, num_entries):
+    # number of lightstyles, lightstyles, weaponmodel, weaponframe,
+    # screen_flash, entries
+    return ([T_UINT8] + [T_STRING] * num_lightstyles +
+            [T_STRING, T_UINT8, T_UINT8] +
+            SNAPSHOT_ENTRY_TYPES * num_entries)
+
 # ------------------------------------------------------------
 
 
 class QuakeServer(object):
 
-    def __init__(self, args, debug_init=False):
-        args = [sys.executable] + args
+    def __init__(self, args, debug_init=False, maxclients=1):
+        # "-listen" sets svs.maxclients, and also "deathmatch 1" if more
+        # than 1: we want coop instead, unless 'args' says otherwise
+        options = ["-listen", str(maxclients)]
+        if maxclients > 1:
+            options += ["+deathmatch", "0", "+coop", "1"]
+        args = [sys.executable] + options + args
         self.argv = [ffi.new("char[]", a) for a in args]
         self.argv_list = ffi.new("char *[]", self.argv)
         lib.PQuake_Ready(len(self.argv), self.argv_list)
-        self.prev_time = time.time()
+        self.prev_time = lib.PQuake_Monotonic_Time()
+        self.sim_accumulator = 0.0
         self.initialized = False
-        self.client = None
-        self.client_ed = None
-        self.prev_weapon_pos = (9999, 0, 0)
         for i in range(30):
             self.host_frame(0.1)
             if lib.progs != ffi.NULL:
@@ -140,59 +191,78 @@ class QuakeServer(object):
                                (args[1:],))
         initialize()
         self.model_by_index = {}
+        self.lightstyle_cache = {}
+        self.visibility = None
+        self.visibility_level = None
+        self.static_leafs = {}
+        self.edict_leafs = {}
 
     def setup(self, playername="quake_player"):
-        def next():
-            time.sleep(0.1)
-            self.host_frame()
-        next()
-        self.spawn_client(playername=playername)
-        next()
-        self.cmd("spawn")
-        next()
-        self.cmd("god")
-        next()
-        self.cmd("noclip")
+        # a single player, for testing
+        time.sleep(0.1)
+        self.host_frame()
+        return self.add_player(playername)
+
+    def add_player(self, playername=None):
+        # Connects and spawns a new player in a free svs.clients slot.
+        # Returns the Player, or None if the server is full.
+        for clientnum in range(lib.svs.maxclients):
+            if not lib.svs.clients[clientnum].active:
+                break
+        else:
+            return None
+        # Like the original single-player setup(), the commands are
+        # run one per host frame, after the connection has gone through
+        # a frame; see run_frame().
+        player = self.spawn_client(clientnum, playername)
+        player.pending_cmds = ["spawn", "god", "noclip"]
+        return player
 
     def spawn_client(self, clientnum=0, playername=None):
         assert 0 <= clientnum < lib.svs.maxclients
-        self.client_ed = Edict(clientnum + 1)
-        self.client = lib.svs.clients + clientnum
-        self.qsocket = ffi.new("qsocket_t *")
-        self.client.netconnection = self.qsocket
+        player = Player(clientnum)
+        player.client.netconnection = player.qsocket
         lib.SV_ConnectClient(clientnum)
         if playername:
-            n = min(len(playername), len(self.client.name)-1)
+            n = min(len(playername), len(player.client.name)-1)
             for i in range(n):
-                self.client.name[i] = playername[i]
-            self.client.name[n] = '\x00'
-
-    def cmd(self, string):
-        lib.host_client = self.client
+                player.client.name[i] = playername[i]
+            player.client.name[n] = '\x00'
+        players_by_entnum[player.ed._index] = player
+        return player
+
+    def remove_player(self, player):
+        # Disconnects the player and frees its svs.clients slot.  Like
+        # in Quake, its body stays around.
+        if players_by_entnum.get(player.ed._index) is player:
+            del players_by_entnum[player.ed._index]
+            lib.PQuake_DropClient(player.clientnum)
+
+    def cmd(self, string, player):
+        lib.host_client = player.client
         lib.PQuake_Cmd_ExecuteString(string, lib.src_client)
 
-    def move_client(self, x1, y1, z1, x2, y2, z2, ax, ay, fire=0):
-        if self.client_ed is None:
-            return
-        self.client_ed.angles = (ax, ay, 0)
+    def move_client(self, player, x1, y1, z1, x2, y2, z2, ax, ay, fire=0):
+        ed = player.ed
+        ed.angles = (ax, ay, 0)
         if fire:
-            lib.PQuake_setorigin(self.client_ed._index, x1, y1, z1, True)
-            lib.PQuake_setorigin(self.client_ed._index, x2, y2, z2, False)
+            lib.PQuake_setorigin(ed._index, x1, y1, z1, True)
+            lib.PQuake_setorigin(ed._index, x2, y2, z2, False)
             # don't push anything when the fire button is down
         else:
-            xp, yp, zp = self.prev_weapon_pos
+            xp, yp, zp = player.prev_weapon_pos
             if sqr(x2 - xp) + sqr(y2 - yp) + sqr(z2 - zp) > 400.0:
                 pass   # probably teleported, don't push anything
             else:
-                lib.PQuake_setorigin(self.client_ed._index, xp, yp, zp, False)
-                lib.PQuake_push(self.client_ed._index, x2-xp, y2-yp, z2-zp)
-            lib.PQuake_setorigin(self.client_ed._index, x1, y1, z1, True)
-        self.prev_weapon_pos = x2, y2, z2
-        self.client_ed.v_angle = (ax, ay, 0)
-        self.client_ed.button0 = fire
+                lib.PQuake_setorigin(ed._index, xp, yp, zp, False)
+                lib.PQuake_push(ed._index, x2-xp, y2-yp, z2-zp)
+            lib.PQuake_setorigin(ed._index, x1, y1, z1, True)
+        player.prev_weapon_pos = x2, y2, z2
+        ed.v_angle = (ax, ay, 0)
+        ed.button0 = fire
 
     def host_frame(self, forced_delay=None):
-        next_time = time.time()
+        next_time = lib.PQuake_Monotonic_Time()
         delay = next_time - self.prev_time
         self.prev_time = next_time
         if forced_delay is not None:
@@ -200,7 +270,39 @@ class QuakeServer(object):
         elif delay > 0.1:
             delay = 0.1
         #print "%.3f host frame" % delay
+        self.run_frame(delay)
+
+    def run_frame(self, delay):
         lib.PQuake_Host_Frame(delay)
+        for player in players_by_entnum.values():
+            if player.pending_cmds:
+                self.cmd(player.pending_cmds.pop(0), player)
+
+    def run_simulation(self, step, max_steps):
+        # Run as many frames of exactly 'step' seconds as the time elapsed
+        # since the previous call, on a monotonic clock; the rest is kept
+        # for the next call.  If we are more than 'max_steps' frames late,
+        # e.g. because the event loop was blocked, the extra time is
+        # dropped instead of making all the following calls slower.
+        # Returns the number of frames run.
+        next_time = lib.PQuake_Monotonic_Time()
+        self.sim_accumulator += next_time - self.prev_time
+        self.prev_time = next_time
+        steps = int(self.sim_accumulator / step)
+        if steps > max_steps:
+            self.sim_accumulator -= (steps - max_steps) * step
+            steps = max_steps
+        for i in range(steps):
+            self.run_frame(step)
+        self.sim_accumulator -= steps * step
+        if steps:
+            # after a map change, load the new map's visibility now
+            # instead of when building the next snapshot
+            self.get_visibility()
+        return steps
+
+    def get_server_time(self):
+        return lib.sv.time
 
     def get_level_model_name(self):
         res = Edict(0).model
@@ -217,9 +319,20 @@ class QuakeServer(object):
         raise LookupError("'info_player_start' not found")
 
     def get_lightstyles(self, first=0):
+        # sv.lightstyles[] are pointers to the strings of the progs,
+        # which don't change: read a string again only if the pointer
+        # changed, and otherwise return the same str object
         lightstyles = []
-        for p in lib.sv.lightstyles[first : len(lib.sv.lightstyles)]:
-            lightstyles.append(ffi.string(p) if p else "a")
+        for i in range(first, len(lib.sv.lightstyles)):
+            p = lib.sv.lightstyles[i]
+            if not p:
+                lightstyles.append("a")
+                continue
+            address = int(ffi.cast("intptr_t", p))
+            cached = self.lightstyle_cache.get(i)
+            if cached is None or cached[0] != address:
+                cached = self.lightstyle_cache[i] = (address, ffi.string(p))
+            lightstyles.append(cached[1])
         return lightstyles
 
     def get_precache_models(self):
@@ -238,6 +351,48 @@ class QuakeServer(object):
         for i in range(n):
             yield StaticEntity(lib.pquake_staticentities[i])
 
+    def get_visibility(self):
+        level = self.get_full_level_path()
+        if level != self.visibility_level:
+            self.visibility_level = level
+            self.static_leafs.clear()
+            self.edict_leafs.clear()
+            try:
+                bsp = maploader.CONTENT[level]
+            except KeyError:
+                self.visibility = None
+            else:
+                self.visibility = LevelVisibility(bsp)
+        return self.visibility
+
+    def get_entity_leafs(self, vis, ed):
+        if isinstance(ed, StaticEntity):
+            # we don't know the size of static entities, but they are
+            # typically small; cache the result, as they don't move
+            key = (ed.modelindex, ed.origin)
+            try:
+                return self.static_leafs[key]
+            except KeyError:
+                x, y, z = ed.origin
+                leafs = vis.box_leafs((x - 16, y - 16, z - 16),
+                                      (x + 16, y + 16, z + 16))
+                self.static_leafs[key] = leafs or None
+                return leafs or None
+        else:
+            # an entity not linked in any leaf is always sent; the
+            # result is cached until the entity moves
+            bounds = (ed.absmin, ed.absmax)
+            try:
+                prev_bounds, leafs = self.edict_leafs[ed._index]
+            except KeyError:
+                pass
+            else:
+                if prev_bounds == bounds:
+                    return leafs
+            leafs = vis.box_leafs(*bounds) or None
+            self.edict_leafs[ed._index] = (bounds, leafs)
+            return leafs
+
     def enum_snapshot_models(self):
         NULLVEC = {'x': 0.0, 'y': 0.0, 'z': 0.0}
         SOLID2FLAGS = {lib.SOLID_NOT:     0x1000,
@@ -245,8 +400,6 @@ class QuakeServer(object):
         #
         for ed in (list(self.enum_static_entities()) +
                    list(edicts(start=1))):
-            if ed == self.client_ed:
-                continue
             index = int(ed.modelindex)
             # ignore entities without a model.  In the same way as
             # Quake, this means ignoring entities that have *either* no
@@ -282,36 +435,82 @@ class QuakeServer(object):
                 flags = 0.0
                 org = NULLVEC
                 ang = NULLVEC
-            yield [model, frame, flags,
-                   org['x'], org['y'], org['z'],
-                   ang['x'], ang['y'], ang['z'],
-                   ]
+            yield ed, [model, frame, flags,
+                       org['x'], org['y'], org['z'],
+                       ang['x'], ang['y'], ang['z'],
+                       ]
 
     def get_snapshot(self):
         lightstyles = self.get_lightstyles(first=32)
-        snapshot = [len(lightstyles)]
+        snapshot = Snapshot([len(lightstyles)])
         snapshot += lightstyles
 
-        snapshot.append(self.client_ed.weaponmodel or "")
-        snapshot.append(self.client_ed.weaponframe)
-
-        global screen_flash
-        snapshot.append(screen_flash)
-        screen_flash = 0
-
-        for entry in self.enum_snapshot_models():
+        # filled for each player by get_player_snapshot()
+        snapshot.player_items_index = len(snapshot)
+        snapshot += ["", 0.0, 0.0]
+
+        vis = self.get_visibility()
+        entity_leafs = []
+        player_entries = {}
+        for ed, entry in self.enum_snapshot_models():
+            if vis is not None and entry[0]:
+                entity_leafs.append((len(snapshot),
+                                     self.get_entity_leafs(vis, ed)))
+            if isinstance(ed, Edict) and ed._index in players_by_entnum:
+                player_entries[ed._index] = len(snapshot)
             snapshot += entry
+        snapshot.entity_leafs = entity_leafs
+        snapshot.player_entries = player_entries
+        num_entries = ((len(snapshot) - len(lightstyles) - 4) //
+                       SNAPSHOT_ENTRY_SIZE)
+        snapshot.types = get_snapshot_types(len(lightstyles), num_entries)
+        snapshot.time = self.get_server_time()
         return snapshot
 
+    def get_player_items(self, player):
+        # weaponmodel, weaponframe, screen_flash
+        ed = player.ed
+        items = [ed.weaponmodel or "", ed.weaponframe, player.screen_flash]
+        player.screen_flash = 0
+        return items
+
+    def get_player_snapshot(self, snapshot, prepared, player, pvs=True):
+        # Returns the snapshot sent to 'player': 'prepared' is 'snapshot'
+        # after snapshots.prepare_snapshot(), shared by all the players.
+        # The player's own edict is never sent, and if 'pvs' is true, the
+        # entities outside its PVS are not sent either.
+        hidden = []
+        if pvs:
+            hidden = self.get_hidden_entities(snapshot, player.ed)
+        own = snapshot.player_entries.get(player.ed._index)
+        if own is not None and own not in hidden:
+            hidden.append(own)
+        result = prepared.hide_entries(hidden, SNAPSHOT_EMPTY_ENTRY)
+        return result.replace_items(snapshot.player_items_index,
+                                    self.get_player_items(player))
+
+    def get_hidden_entities(self, snapshot, viewer_ed):
+        # Returns the list of indices in the snapshot where an entity
+        # starts that is not in the PVS of 'viewer_ed'.
+        if not snapshot.entity_leafs or viewer_ed is None:
+            return []
+        x, y, z = viewer_ed.origin
+        vx, vy, vz = viewer_ed.view_ofs
+        pvs = self.visibility.fat_pvs((x + vx, y + vy, z + vz))
+        if pvs is None:
+            return []       # outside the level: no culling
+        return [index for index, leafs in snapshot.entity_leafs
+                if leafs is not None and not (leafs & pvs)]
+
 
 if __name__ == "__main__":
     srv = QuakeServer(sys.argv[1:])
-    srv.setup()
+    player = srv.setup()
     n = 0
     print "ping!"; time.sleep(1.5)
     while True:
         time.sleep(0.1)
-        srv.move_client(538.3253, 733.311, 112.0) # XXX
+        srv.move_client(player, 538.3253, 733.311, 112.0) # XXX
         srv.host_frame()
         n += 1
         #if n == 5:
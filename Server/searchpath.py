@@ -0,0 +1,177 @@
+import os, json, hashlib
+import qdata
+
+
+def get_game_dirs(args):
+    # like Quake: always 'id1', plus the mod directory given by '-game'
+    gamedirs = ['id1']
+    if '-game' in args[:-1]:
+        gamedir = args[args.index('-game') + 1]
+        if gamedir != 'id1':
+            gamedirs.append(gamedir)
+    return gamedirs
+
+
+class SearchPath(object):
+    """The virtual file system made of the game directories, searched in
+    the same order as Quake: later game directories override earlier
+    ones; inside a game directory, pakN.pak overrides ... overrides
+    pak0.pak, which overrides the loose files.
+
+    Behaves like a read-only dict {filename: QData}.  The entries are
+    decoded on first access.  Their 'rawdata' is always a read-only
+    buffer inside a mmap of the pak or loose file, like the entries of
+    qdata.QPak: it supports len(), indexing and slicing (which return
+    strings), numpy.frombuffer() and hashlib, but not the str methods.
+    The directory is only looked at when first needed.  If
+    'index_filename' is set by then, the merged directory is saved in
+    that file and reused as long as the paks, the directories and the
+    loose files have the same modification times and sizes.
+    """
+    INDEX_VERSION = 2
+
+    def __init__(self, gamedirs, index_filename=None, arrays=False):
+        self.gamedirs = list(gamedirs)
+        self.index_filename = index_filename
+        self.arrays = arrays
+        self._files = {}       # {path: mmap}
+        self._content = {}     # {name: QData}
+        self._digests = {}     # {name: sha1 hex digest}
+
+    def __getattr__(self, attr):
+        # 'directory' and 'stamps' are loaded on first access
+        if attr not in ('directory', 'stamps'):
+            raise AttributeError(attr)
+        if not self.load_index():
+            self.build_directory()
+            self.save_index()
+        return self.__dict__[attr]
+
+    def build_directory(self):
+        # self.directory is {name: (path, ofs, size)}, with 'ofs' being
+        # None for loose files; self.stamps is {path: (mtime, size)} for
+        # all directories, paks and loose files that we looked at
+        self.directory = {}
+        self.stamps = {}
+        for gamedir in self.gamedirs:
+            for dirpath, dirnames, filenames in os.walk(gamedir):
+                dirnames.sort()
+                self.add_stamp(dirpath)
+                for filename in sorted(filenames):
+                    if filename.endswith('.pak'):
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    name = os.path.relpath(path, gamedir)
+                    self.add_stamp(path)
+                    self.directory[name.replace(os.sep, '/')] = (
+                        path, None, self.stamps[path][1])
+            i = 0
+            while True:
+                path = os.path.join(gamedir, 'pak%d.pak' % i)
+                if not os.path.exists(path):
+                    break
+                self.add_stamp(path)
+                pak = qdata.QPak(self.get_file(path))
+                for entry in pak.entries:
+                    self.directory[entry.name] = (path, entry.ofs, entry.size)
+                i += 1
+
+    def add_stamp(self, path):
+        st = os.stat(path)
+        self.stamps[path] = (st.st_mtime, st.st_size)
+
+    def load_index(self):
+        if self.index_filename is None:
+            return False
+        try:
+            with open(self.index_filename) as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            return False
+        if (index.get('version') != self.INDEX_VERSION or
+                index.get('gamedirs') != self.gamedirs):
+            return False
+        stamps = {}
+        for path, stamp in index['stamps'].items():
+            path = str(path)
+            try:
+                st = os.stat(path)
+            except OSError:
+                return False
+            if (st.st_mtime, st.st_size) != tuple(stamp):
+                return False
+            stamps[path] = tuple(stamp)
+        self.stamps = stamps
+        self.directory = {}
+        for name, (path, ofs, size) in index['directory'].items():
+            self.directory[str(name)] = (str(path), ofs, size)
+        return True
+
+    def save_index(self):
+        if self.index_filename is None:
+            return
+        index = {
+            'version': self.INDEX_VERSION,
+            'gamedirs': self.gamedirs,
+            'stamps': self.stamps,
+            'directory': self.directory,
+        }
+        tmpname = '%s.%d.tmp' % (self.index_filename, os.getpid())
+        try:
+            with open(tmpname, 'w') as f:
+                json.dump(index, f)
+            os.rename(tmpname, self.index_filename)
+        except (IOError, OSError), e:
+            print "cannot write %r: %s" % (self.index_filename, e)
+
+    def get_file(self, path):
+        try:
+            return self._files[path]
+        except KeyError:
+            data = self._files[path] = qdata.map_file(path)
+            return data
+
+    def get_rawdata(self, name):
+        # the original bytes of the entry, as a buffer
+        path, ofs, size = self.directory[name]
+        data = self.get_file(path)
+        ofs = ofs or 0
+        assert ofs + size <= len(data), "%r: premature end of file" % (
+            path,)
+        return buffer(data, ofs, size)
+
+    def get_digest(self, name):
+        try:
+            return self._digests[name]
+        except KeyError:
+            digest = hashlib.sha1(self.get_rawdata(name)).hexdigest()
+            self._digests[name] = digest
+            return digest
+
+    def __getitem__(self, name):
+        try:
+            return self._content[name]
+        except KeyError:
+            pass
+        data = self.get_rawdata(name)
+        ext = name[name.rfind('.'):]
+        cls = qdata.GUESS_CLASS.get(ext, qdata.QData)
+        result = self._content[name] = cls(data, arrays=self.arrays)
+        return result
+
+    def __contains__(self, name):
+        return name in self.directory
+
+    def __iter__(self):
+        return iter(self.directory)
+
+    def __len__(self):
+        return len(self.directory)
+
+    def keys(self):
+        return self.directory.keys()
+
+    def get(self, name, default=None):
+        if name in self.directory:
+            return self[name]
+        return default
@@ -1,58 +1,138 @@
 #!/usr/bin/env python
 
-import sys
 import os
 import time
 import json
 import cStringIO
-import struct
+import gzip
 import tornado.ioloop
 import tornado.web
 import tornado.websocket
 import tornado.escape
+import tornado.gen
 from tornado.options import define, options
 from tornado.log import enable_pretty_logging
 
 import maploader
 import quakelib
+import assetcache
+import assetpool
+import wireformat
+import snapshots
 
 
-WEBSOCK_VERSION = 4
+# limit_window_bits() and CompressionStats use internals of the websocket
+# compressor of this version of tornado
+TORNADO_COMPRESSOR_VERSION = (5, 1)
+
+WEBSOCK_VERSION = 7      # the latest; older versions are still served
 
 
 define("port", default=8000, help="run on the given port", type=int)
+define("pvs", default=True, type=bool,
+       help="only send the entities potentially visible by the player")
+define("maxclients", default=4, type=int,
+       help="maximum number of players connected at the same time")
+define("cache_dir", default="cache",
+       help="directory for the cached /level and /model responses")
+define("cache_size", default=512*1024*1024, type=int,
+       help="maximum total size of the files in cache_dir")
+define("asset_workers", default=2, type=int,
+       help="worker processes building the /level and /model responses "
+            "(0: build them in the server process)")
+define("asset_timeout", default=300.0, type=float,
+       help="seconds after which a build in a worker process is given up, "
+            "e.g. because the worker was killed")
+define("ws_compression", default=True, type=bool,
+       help="compress the websocket messages with permessage-deflate, "
+            "if the client offers it")
+define("ws_compression_level", default=6, type=int,
+       help="zlib compression level of the websocket, 1-9")
+define("ws_window_bits", default=15, type=int,
+       help="zlib window size of the websocket compression, 9-15 "
+            "(2**n bytes; zlib doesn't support 8 for raw deflate)")
+define("ws_mem_level", default=8, type=int,
+       help="zlib memory level of the websocket compression, 1-9")
+define("sim_rate", default=72.0, type=float,
+       help="simulation frames per second, at most 72 (Quake skips "
+            "the frames that are shorter than 1/72 second)")
+define("sim_max_catch_up", default=10, type=int,
+       help="maximum number of simulation frames run at once to catch "
+            "up after a delay; the rest of the delay is dropped")
+define("send_rate", default=10.0, type=float,
+       help="snapshots sent per second to each client")
+define("ws_max_buffered", default=0, type=int,
+       help="don't send a snapshot to a client while more than this "
+            "number of bytes of the previous ones are not written to "
+            "its socket; the next snapshot will contain the changes")
+
+
+def check_options():
+    # Raises tornado.options.Error for the values that would otherwise
+    # only fail later, after Quake is started.
+    def check(name, valid, expected):
+        if not valid:
+            raise tornado.options.Error("--%s=%s: must be %s" % (
+                name, getattr(options, name), expected))
+    check("sim_rate", 0 < options.sim_rate <= 72, "more than 0, at most 72")
+    check("send_rate", options.send_rate > 0, "more than 0")
+    check("ws_compression_level", 1 <= options.ws_compression_level <= 9,
+          "1-9")
+    check("ws_window_bits", 9 <= options.ws_window_bits <= 15, "9-15")
+    check("ws_mem_level", 1 <= options.ws_mem_level <= 9, "1-9")
+    check("ws_max_buffered", options.ws_max_buffered >= 0, "0 or more")
 
 
 class Application(tornado.web.Application):
 
-    def __init__(self):
+    def __init__(self, args):
+        check_options()
         handlers = [
             (r"/hello", HelloHandler),
             (r"/level/([A-Za-z0-9_-]+)", LevelHandler),
+            (r"/level/([A-Za-z0-9_-]+)/chunk/([0-9]+)", LevelChunkHandler),
             (r"/model/([/.A-Za-z0-9_,-]+)", ModelHandler),
-            (r"/websock/%d" % WEBSOCK_VERSION, WebSockHandler),
+            (r"/websock/(%s)" % "|".join(map(str, snapshots.VERSIONS)),
+             WebSockHandler),
         ]
         super(Application, self).__init__(handlers, static_path="static",
                                           compress_response=True)
         self.clients = {}
+        self.asset_cache = assetcache.AssetCache(options.cache_dir,
+                                                 options.cache_size)
+        maploader.CONTENT.index_filename = os.path.join(options.cache_dir,
+                                                        'searchpath.index')
+        # started before Quake, so that the workers don't inherit it
+        self.asset_pool = assetpool.AssetPool(options.asset_workers,
+                                              self.asset_cache,
+                                              options.asset_timeout)
         #
-        if len(sys.argv) > 1:
-            args = sys.argv[1:]
-        else:
+        if not args:
             args = ["+map", "e1m1"]
-        self.srv = quakelib.QuakeServer(args)
-        self.srv.setup()
+        self.srv = quakelib.QuakeServer(args, maxclients=options.maxclients)
         #
+        self.sim_step = 1.0 / options.sim_rate
+        self.sim_callback = tornado.ioloop.PeriodicCallback(
+            self.invoke_simulation, 1000.0 * self.sim_step)
+        self.sim_callback.start()
         self.periodic_callback = tornado.ioloop.PeriodicCallback(
-            self.invoke_periodic_callback, 100)     # 10 per second
+            self.invoke_periodic_callback, 1000.0 / options.send_rate)
         self.periodic_callback.start()
 
+    def invoke_simulation(self):
+        self.srv.run_simulation(self.sim_step, options.sim_max_catch_up)
+
     def invoke_periodic_callback(self):
-        self.srv.host_frame()
         if self.clients:
             snapshot = self.srv.get_snapshot()
+            prepared = snapshots.prepare_snapshot(snapshot,
+                                                  snapshot.types,
+                                                  snapshot.time)
             for client in self.clients.values():
-                client.update_snapshot(snapshot)
+                if not client.wants_snapshot():
+                    continue
+                client.update_snapshot(self.srv.get_player_snapshot(
+                    snapshot, prepared, client.player, options.pvs))
 
 
 def write_json_response(handler, response):
@@ -60,6 +140,33 @@ def write_json_response(handler, response):
     handler.set_header('Content-Type', 'application/json')
     handler.write(answer)
 
+@tornado.gen.coroutine
+def write_cached_asset_response(handler, key, build, *args, **kwds):
+    # Sends the result of build(*args, **kwds) either as JSON or, if the
+    # client accepts it, in the binary format of wireformat.py.  The
+    # cache contains the gzipped answer, which we send as it is if the
+    # client accepts gzip.  If it is not in the cache, it is built and
+    # cached by app.asset_pool in a worker process.
+    binary = wireformat.CONTENT_TYPE in handler.request.headers.get(
+        'Accept', '')
+    if binary:
+        content_type = wireformat.CONTENT_TYPE
+        key += ':binary%d' % (wireformat.FORMAT_VERSION,)
+    else:
+        content_type = 'application/json'
+    compressed = app.asset_cache.get(key)
+    if compressed is None:
+        compressed = yield app.asset_pool.build(key, build, args, kwds,
+                                                binary)
+    handler.set_header('Content-Type', content_type)
+    handler.set_header('Vary', 'Accept, Accept-Encoding')
+    if 'gzip' in handler.request.headers.get('Accept-Encoding', ''):
+        handler.set_header('Content-Encoding', 'gzip')
+        handler.write(compressed)
+    else:
+        g = gzip.GzipFile(fileobj=cStringIO.StringIO(compressed))
+        handler.write(g.read())
+
 
 class HelloHandler(tornado.web.RequestHandler):
     def get(self):
@@ -74,31 +181,77 @@ class HelloHandler(tornado.web.RequestHandler):
         }
         write_json_response(self, response)
 
+def get_flag(handler, name):
+    # '?atlas=1' asks for the textures packed in atlas pages,
+    # '?compact=1' for the quantized frames of .mdl models, and
+    # '?stream=1' for the manifest of a level sent in chunks
+    return handler.get_argument(name, '0') == '1'
+
 class LevelHandler(tornado.web.RequestHandler):
+    @tornado.gen.coroutine
     def get(self, level_name):
-        level = maploader.load_level(level_name)
-        write_json_response(self, level)
+        options = {'use_atlas': get_flag(self, 'atlas'),
+                   'stream': get_flag(self, 'stream')}
+        key = maploader.get_cache_key('level', level_name, **options)
+        yield write_cached_asset_response(
+            self, key, maploader.load_level, level_name, **options)
+
+class LevelChunkHandler(tornado.web.RequestHandler):
+    @tornado.gen.coroutine
+    def get(self, level_name, index):
+        index = int(index)
+        use_atlas = get_flag(self, 'atlas')
+        key = maploader.get_cache_key('level', level_name,
+                                      use_atlas=use_atlas, chunk=index)
+        try:
+            yield write_cached_asset_response(
+                self, key, maploader.load_level_chunk, level_name, index,
+                use_atlas)
+        except IndexError:
+            raise tornado.web.HTTPError(404)
 
 class ModelHandler(tornado.web.RequestHandler):
+    @tornado.gen.coroutine
     def get(self, model_name):
-        model = maploader.load_model(model_name)
-        write_json_response(self, model)
+        options = {'use_atlas': get_flag(self, 'atlas'),
+                   'compact': get_flag(self, 'compact')}
+        key = maploader.get_cache_key('model', model_name, **options)
+        yield write_cached_asset_response(
+            self, key, maploader.load_model, model_name, **options)
 
 class WebSockHandler(tornado.websocket.WebSocketHandler):
 
-    #XXX check if on the Unity side compression is ok too
-    #def get_compression_options(self):
-    #    # Non-None enables compression with default options.
-    #    return {}
+    def get_compression_options(self):
+        # Non-None enables compression, if the client asks for it in the
+        # handshake.  The compressor keeps its context between messages
+        # unless the client asks for "server_no_context_takeover".
+        if not options.ws_compression:
+            return None
+        return {'compression_level': options.ws_compression_level,
+                'mem_level': options.ws_mem_level}
 
-    def open(self):
-        print "opening websock"
-        app.clients[self] = Client(self, app.srv)
+    def open(self, version):
+        print "opening websock version", version
+        self.compression_stats = None
+        compressor = getattr(self.ws_connection, '_compressor', None)
+        if (compressor is not None and
+                tornado.version_info[:2] == TORNADO_COMPRESSOR_VERSION):
+            limit_window_bits(compressor, options.ws_window_bits)
+            self.compression_stats = CompressionStats(compressor)
+        player = app.srv.add_player()
+        if player is None:
+            print "server full (--maxclients=%d)" % (options.maxclients,)
+            self.close(1013, "server full")     # "try again later"
+            return
+        app.clients[self] = Client(self, app.srv, player, int(version))
 
     def on_close(self):
-        client = app.clients.pop(self)
-        client.close()
+        client = app.clients.pop(self, None)
+        if client is not None:
+            client.close()
         print "closed websock"
+        if self.compression_stats is not None:
+            print "websock compression:", self.compression_stats
 
     def on_message(self, message):
         client = app.clients[self]
@@ -106,48 +259,90 @@ class WebSockHandler(tornado.websocket.WebSocketHandler):
         getattr(client, 'gs_cmsg_' + message[0])(*message[1:])
 
 
+def limit_window_bits(compressor, window_bits):
+    # Tornado only uses the window size given by the client in the
+    # handshake, 15 by default.  Compressing with a smaller window is
+    # always fine for the client, so we don't need to tell it.
+    if window_bits < compressor._max_wbits:
+        compressor._max_wbits = window_bits
+        if compressor._compressor is not None:
+            compressor._compressor = compressor._create_compressor()
+
+
+class CompressionStats(object):
+    # Accounting of the compression of one websocket: the number of
+    # bytes before and after compression, and the CPU time spent in
+    # the compressor.
+
+    def __init__(self, compressor):
+        self.messages = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.cpu_time = 0.0
+        compress = compressor.compress
+
+        def counting_compress(data):
+            start = time.clock()
+            result = compress(data)
+            self.cpu_time += time.clock() - start
+            self.messages += 1
+            self.raw_bytes += len(data)
+            self.compressed_bytes += len(result)
+            return result
+        compressor.compress = counting_compress
+
+    def get_ratio(self):
+        return self.compressed_bytes / float(self.raw_bytes or 1)
+
+    def __str__(self):
+        return ("%d messages, %d bytes compressed to %d (%.1f%%), "
+                "%.3f ms CPU per message" % (
+                    self.messages, self.raw_bytes, self.compressed_bytes,
+                    self.get_ratio() * 100.0,
+                    self.cpu_time * 1000.0 / (self.messages or 1)))
+
+
 class Client(object):
-    def __init__(self, ws, srv):
+    def __init__(self, ws, srv, player, version=WEBSOCK_VERSION):
         self.ws = ws
-        self.prev_snapshot = []
+        self.encoder = snapshots.new_encoder(version)
         self.srv = srv
+        self.player = player        # a quakelib.Player
+        self.buffered_bytes = 0     # sent but not written to the socket
+        self.skipped = 0            # ticks skipped since the last send
+        self.skipped_total = 0
+        self.merged_total = 0       # messages that include skipped ticks
+
+    def wants_snapshot(self):
+        # False if the client is slow to receive the previous snapshots.
+        # We skip this tick; the encoder still has the last snapshot
+        # actually sent, so the next message contains the changes of
+        # all the skipped ticks.
+        if self.buffered_bytes > options.ws_max_buffered:
+            self.skipped += 1
+            self.skipped_total += 1
+            return False
+        return True
 
     def update_snapshot(self, snapshot):
-        # Compress a list containing floats and strings, based on the
-        # previous-sent list.  Strings are supposed to change rarely.
-        # The compression sends just one bit for every item in the list
-        # that was not modified.
-        #
-        snapshot += [0.0] * ((-len(snapshot)) & 7)
-        prev_snapshot = self.prev_snapshot
-        if len(prev_snapshot) < len(snapshot):
-            prev_snapshot += [0.0] * (len(snapshot) - len(prev_snapshot))
-        #
-        f = cStringIO.StringIO()
-        header, header_bits, block = 0, 0, ""
-        #
-        for prev, entry in zip(prev_snapshot, snapshot):
-            if entry != prev:
-                header |= (1 << header_bits)
-                if isinstance(entry, str):
-                    nan_header = "\xff\xc0"
-                    block += nan_header + chr(len(entry)) + entry
-                else:
-                    if entry != entry:     # NaN?
-                        entry = 0.0
-                    block += struct.pack("!f", entry)
-            header_bits += 1
-            if header_bits == 8:
-                f.write(chr(header) + block)
-                header, header_bits, block = 0, 0, ""
-        #
-        assert header_bits == 0
-        self.prev_snapshot = snapshot
-        #
-        self.ws.write_message(f.getvalue())
+        # 'snapshot' comes from snapshots.prepare_snapshot(); only the
+        # items that changed since the previous call are sent
+        message = self.encoder.encode(snapshot)
+        if self.skipped:
+            self.merged_total += 1
+            self.skipped = 0
+        self.buffered_bytes += len(message)
+        future = self.ws.write_message(message)
+        future.add_done_callback(lambda f: self.written(len(message)))
+
+    def written(self, size):
+        self.buffered_bytes -= size
 
     def close(self):
-        pass
+        self.srv.remove_player(self.player)
+        if self.skipped_total:
+            print "slow websock: skipped %d ticks, merged in %d messages" % (
+                self.skipped_total, self.merged_total)
 
     def gs_cmsg_tel(self, sx1, sy1, sz1, sx2, sy2, sz2, ax, ay, fire=0):
         x1,y1,z1 = maploader.rev_map_vertex(float(sx1), float(sy1), float(sz1))
@@ -157,14 +352,21 @@ class Client(object):
         ax = float(ax)
         ay = 90.0 - float(ay)
         #print (x, y, z, ax, ay, fire)
-        self.srv.move_client(x1, y1, z1, x2, y2, z2, ax, ay, fire=int(fire))
+        self.srv.move_client(self.player, x1, y1, z1, x2, y2, z2, ax, ay,
+                             fire=int(fire))
 
 
 def main():
     global app
     enable_pretty_logging()
-    #tornado.options.parse_command_line()
-    app = Application()
+    # our options come first, e.g. '--port=8000 +map e1m3'; the remaining
+    # arguments are passed to Quake (use '--' before Quake's own '-xyz')
+    args = tornado.options.parse_command_line()
+    try:
+        check_options()
+    except tornado.options.Error, e:
+        raise SystemExit("error: %s" % (e,))
+    app = Application(args)
     app.listen(options.port)
     print "Listening on port %d" % (options.port,)
     os.system("ifconfig | grep inet")
@@ -0,0 +1,452 @@
+import math
+import struct
+import cStringIO
+from qdata import numpy
+
+
+# Delta encoding of the snapshots sent to the clients over the websocket.
+# A snapshot is a list of floats and strings.  It is padded with 0.0 to
+# a multiple of 8 items, and sent in groups of 8 items: one byte whose
+# bit 'n' says if the item 'n' of the group changed since the previous
+# snapshot sent to the same client, followed by the changed items.
+#
+# Version 4: a float is sent as 4 bytes "!f" (NaN is sent as 0.0), and a
+# string as "\xff\xc0" (the start of a NaN), one byte of length, and the
+# characters.
+#
+# Version 5: every item has a type, which depends on its position in the
+# snapshot (see quakelib.get_snapshot_types()) and says how it is sent,
+# always in network byte order:
+#
+#    T_FLOAT     4 bytes "!f", like version 4
+#    T_STRING    one byte of length and the characters, without "\xff\xc0"
+#    T_UINT8     1 byte, rounded and clamped to 0..255
+#    T_UINT16    2 bytes, rounded and clamped to 0..65535
+#    T_ORIGIN    2 bytes, signed, in 1/8 units: -4096.0..4095.875
+#    T_ANGLE     1 byte, in 1/256 of a full turn
+#
+# The padding items are T_UINT8.  An item is sent only if its quantized
+# value changed.
+#
+# Version 6: like version 5, but every connection has its own table of
+# strings and a T_STRING item is sent as the 2-bytes number of its
+# string in the table.  The empty string is number 0.  A message starts
+# with the strings that are added to the table: 2 bytes for how many,
+# then for each one its 2-bytes number, one byte of length and the
+# characters.  The strings are added once and never removed, so a
+# string item is sent only when it changes to another string.
+#
+# Version 7: like version 6, but a message starts with the time of the
+# server when the snapshot was taken, in seconds, as 8 bytes "!d".  The
+# clients can use it to interpolate between the snapshots.
+
+VERSIONS = (4, 5, 6, 7)
+
+STRING_HEADER = "\xff\xc0"
+
+T_FLOAT = 0
+T_STRING = 1
+T_UINT8 = 2
+T_UINT16 = 3
+T_ORIGIN = 4
+T_ANGLE = 5
+
+TYPE_SIZES = {T_FLOAT: 4, T_UINT8: 1, T_UINT16: 2, T_ORIGIN: 2, T_ANGLE: 1}
+MAX_STRINGS = 0x10000
+
+
+def round_half_up(value):
+    # rounding used by both quantize() and SnapshotArrays.get_quantized(),
+    # which must give the same integers: not Python's round(), which
+    # rounds the ties away from zero, nor numpy.round(), which rounds
+    # them to even
+    return int(math.floor(value + 0.5))
+
+def quantize(type, value):
+    # the integer sent since version 5 for an item of the given type
+    if value != value:    # NaN
+        value = 0.0
+    if type == T_ORIGIN:
+        return min(max(round_half_up(value * 8.0), -32768), 32767)
+    if type == T_ANGLE:
+        return round_half_up(value * (256.0 / 360.0)) & 0xFF
+    if type == T_UINT8:
+        return min(max(round_half_up(value), 0), 0xFF)
+    if type == T_UINT16:
+        return min(max(round_half_up(value), 0), 0xFFFF)
+    raise ValueError(type)
+
+
+def get_padded_types(types, n):
+    # the T_xxx of the 'n' items of a padded snapshot: T_UINT8 for the
+    # padding
+    types = list(types[:n])
+    return types + [T_UINT8] * (n - len(types))
+
+
+class StringTable(object):
+    # The strings of a connection since version 6, with their number.
+
+    def __init__(self):
+        self.numbers = {"": 0}
+        self.added = []
+
+    def get_number(self, string):
+        try:
+            return self.numbers[string]
+        except KeyError:
+            number = len(self.numbers)
+            assert number < MAX_STRINGS, "too many strings in the snapshots"
+            assert len(string) < 256, "string too long: %r" % (string,)
+            self.numbers[string] = number
+            self.added.append(string)
+            return number
+
+    def pop_added(self):
+        # the start of the message: the strings added since the last call
+        added = self.added
+        self.added = []
+        first = len(self.numbers) - len(added)
+        block = [struct.pack("!H", len(added))]
+        for i, string in enumerate(added):
+            block.append(struct.pack("!HB", first + i, len(string)))
+            block.append(string)
+        return ''.join(block)
+
+
+class PySnapshot(list):
+    # A snapshot for PySnapshotEncoder, used if numpy is not available.
+    # 'types' is the list of T_xxx, needed since version 5, and 'time'
+    # is the server time, needed since version 7.
+
+    def __init__(self, snapshot, types=None, time=0.0):
+        list.__init__(self, snapshot)
+        self.types = types
+        self.time = time
+
+    def hide_entries(self, indices, empty_entry):
+        # a copy in which the entries starting at 'indices' are replaced
+        # with 'empty_entry'
+        result = PySnapshot(self, self.types, self.time)
+        for index in indices:
+            result[index : index + len(empty_entry)] = empty_entry
+        return result
+
+    def replace_items(self, index, items):
+        # a copy in which the items starting at 'index' are replaced
+        # with 'items'
+        return self.hide_entries([index], items)
+
+
+class SnapshotArrays(object):
+    # A snapshot for SnapshotEncoder, converted once and shared by all
+    # the clients: 'values' are the floats (0.0 for strings), 'is_str'
+    # says which items are strings and 'strings' is an object array with
+    # the strings (None for floats).  'types' are the T_xxx of the items,
+    # needed since version 5.  They are padded to a multiple of 8.
+    # 'time' is the server time, needed since version 7.
+
+    # for a copy made by hide_entries(): (parent, indices of the items
+    # that differ), so that get_quantized() only redoes these items
+    quantized_base = None
+
+    def __init__(self, snapshot=(), types=None, time=0.0):
+        self.time = time
+        n = (len(snapshot) + 7) & ~7
+        padding = [0.0] * (n - len(snapshot))
+        strings = numpy.array(list(snapshot) + padding, object)
+        self.is_str = numpy.array(map(type, snapshot) +
+                                  [float] * len(padding), object) == str
+        values = strings.copy()
+        values[self.is_str] = 0.0
+        self.values = values.astype(float)
+        strings[~self.is_str] = None
+        self.strings = strings
+        self.types = numpy.empty(n, numpy.uint8)
+        self.types[:len(snapshot)] = T_FLOAT if types is None else types
+        self.types[len(snapshot):] = T_UINT8
+
+    def __len__(self):
+        return len(self.values)
+
+    def copy(self):
+        result = SnapshotArrays.__new__(SnapshotArrays)
+        result.values = self.values.copy()
+        result.is_str = self.is_str.copy()
+        result.strings = self.strings.copy()
+        result.types = self.types
+        result.time = self.time
+        return result
+
+    def resized(self, n):
+        # cut or padded with 0.0 to 'n' items
+        if n == len(self.values):
+            return self
+        k = min(n, len(self.values))
+        result = SnapshotArrays()
+        result.values = numpy.zeros(n)
+        result.values[:k] = self.values[:k]
+        result.is_str = numpy.zeros(n, bool)
+        result.is_str[:k] = self.is_str[:k]
+        result.strings = numpy.empty(n, object)
+        result.strings[:k] = self.strings[:k]
+        result.types = numpy.empty(n, numpy.uint8)
+        result.types[:k] = self.types[:k]
+        result.types[k:] = T_UINT8
+        return result
+
+    def hide_entries(self, indices, empty_entry):
+        # a copy in which the entries starting at 'indices' are replaced
+        # with 'empty_entry'
+        if not len(indices):
+            return self
+        result = self.copy()
+        empty = SnapshotArrays(empty_entry)
+        k = len(empty_entry)
+        indices = numpy.asarray(indices)[:, None] + numpy.arange(k)
+        result.values[indices] = empty.values[:k]
+        result.is_str[indices] = empty.is_str[:k]
+        result.strings[indices] = empty.strings[:k]
+        result.quantized_base = (self, indices.ravel())
+        return result
+
+    def replace_items(self, index, items):
+        # a copy in which the items starting at 'index' are replaced
+        # with 'items'
+        return self.hide_entries([index], items)
+
+    def get_quantized(self):
+        # the integers sent since version 5, computed once per snapshot;
+        # the copies made for each client only redo their changed items
+        if 'quantized' in self.__dict__:
+            return self.quantized
+        if self.quantized_base is None:
+            q = quantize_arrays(self.values, self.types)
+        else:
+            parent, indices = self.quantized_base
+            q = parent.get_quantized().copy()
+            q[indices] = quantize_arrays(self.values[indices],
+                                         self.types[indices])
+        self.quantized = q
+        return q
+
+
+def quantize_arrays(values, types):
+    # like quantize() on arrays of values and types, rounded like
+    # round_half_up()
+    values = numpy.where(values == values, values, 0.0)
+    q = numpy.zeros(len(values), numpy.int64)
+    mask = types == T_ORIGIN
+    q[mask] = numpy.clip(numpy.floor(values[mask] * 8.0 + 0.5),
+                         -32768, 32767)
+    mask = types == T_ANGLE
+    q[mask] = numpy.floor(values[mask] * (256.0 / 360.0) + 0.5).astype(
+        numpy.int64) & 0xFF
+    mask = types == T_UINT8
+    q[mask] = numpy.clip(numpy.floor(values[mask] + 0.5), 0, 0xFF)
+    mask = types == T_UINT16
+    q[mask] = numpy.clip(numpy.floor(values[mask] + 0.5), 0, 0xFFFF)
+    return q
+
+
+def prepare_snapshot(snapshot, types=None, time=0.0):
+    # Convert the snapshot, a list of floats and strings, for the
+    # encoders returned by new_encoder().  The result has a method
+    # hide_entries() for the culling of each client.
+    if numpy is not None:
+        return SnapshotArrays(snapshot, types, time)
+    return PySnapshot(snapshot, types, time)
+
+
+class PySnapshotEncoder(object):
+    # Pure Python version, used if numpy is not available.
+
+    def __init__(self, version=4):
+        assert version in VERSIONS
+        self.version = version
+        self.prev_snapshot = []
+        self.prev_types = []
+        self.strings = StringTable()
+
+    def encode(self, snapshot):
+        # Strings are supposed to change rarely.
+        types = getattr(snapshot, 'types', None)
+        time = getattr(snapshot, 'time', 0.0)
+        snapshot = list(snapshot)
+        if types is None:
+            types = [T_FLOAT] * len(snapshot)
+        snapshot += [0.0] * ((-len(snapshot)) & 7)
+        types = get_padded_types(types, len(snapshot))
+        prev_snapshot = self.prev_snapshot
+        prev_types = self.prev_types
+        if len(prev_snapshot) < len(snapshot):
+            prev_snapshot += [0.0] * (len(snapshot) - len(prev_snapshot))
+            prev_types += [T_UINT8] * (len(snapshot) - len(prev_types))
+        if self.version >= 6:
+            quantized = [self.strings.get_number(entry)
+                         if isinstance(entry, str) else
+                         entry if type == T_FLOAT else
+                         quantize(type, entry)
+                         for type, entry in zip(types, snapshot)]
+        elif self.version == 5:
+            quantized = [entry if isinstance(entry, str) or
+                                  type == T_FLOAT else
+                         quantize(type, entry)
+                         for type, entry in zip(types, snapshot)]
+        else:
+            quantized = snapshot
+        #
+        f = cStringIO.StringIO()
+        if self.version >= 7:
+            f.write(struct.pack("!d", time))
+        if self.version >= 6:
+            f.write(self.strings.pop_added())
+        header, header_bits, block = 0, 0, []
+        #
+        for prev, entry, type, prev_type in zip(prev_snapshot, quantized,
+                                                types, prev_types):
+            if entry != prev or (self.version > 4 and type != prev_type):
+                header |= (1 << header_bits)
+                if isinstance(entry, str):
+                    if self.version == 4:
+                        block.append(STRING_HEADER)
+                    block.append(chr(len(entry)) + entry)
+                elif self.version == 4 or type == T_FLOAT:
+                    if entry != entry:     # NaN?
+                        entry = 0.0
+                    block.append(struct.pack("!f", entry))
+                elif type != T_STRING and TYPE_SIZES[type] == 1:
+                    block.append(chr(entry))
+                else:
+                    block.append(struct.pack("!H", entry & 0xFFFF))
+            header_bits += 1
+            if header_bits == 8:
+                f.write(chr(header))
+                f.write(''.join(block))
+                header, header_bits, block = 0, 0, []
+        #
+        assert header_bits == 0
+        self.prev_snapshot = quantized
+        self.prev_types = types
+        return f.getvalue()
+
+
+class SnapshotEncoder(object):
+    # Same result as PySnapshotEncoder, with numpy.  The previous
+    # snapshot is kept as a SnapshotArrays.
+
+    def __init__(self, version=4):
+        assert version in VERSIONS
+        self.version = version
+        self.prev = SnapshotArrays()
+        self.prev_quantized = numpy.zeros(0, numpy.int64)
+        self.strings = StringTable()
+        self.item_sizes = numpy.zeros(256, int)
+        for type, size in TYPE_SIZES.items():
+            self.item_sizes[type] = size
+        if version >= 6:
+            self.item_sizes[T_STRING] = 2
+
+    def encode(self, snapshot):
+        if not isinstance(snapshot, SnapshotArrays):
+            snapshot = SnapshotArrays(snapshot,
+                                      getattr(snapshot, 'types', None),
+                                      getattr(snapshot, 'time', 0.0))
+        n = len(snapshot)
+        is_str = snapshot.is_str
+        strings = snapshot.strings
+        types = snapshot.types
+        prev = self.prev.resized(n)
+        self.prev = snapshot
+
+        if self.version > 4:
+            quantized = snapshot.get_quantized()
+            if self.version >= 6:
+                # the strings become numbers in the table, which makes
+                # them like any other integer
+                quantized = quantized.copy()
+                for i in numpy.nonzero(is_str)[0]:
+                    quantized[i] = self.strings.get_number(strings[i])
+                is_str = numpy.zeros(n, bool)
+            prev_quantized = numpy.zeros(n, numpy.int64)
+            k = min(n, len(self.prev_quantized))
+            prev_quantized[:k] = self.prev_quantized[:k]
+            self.prev_quantized = quantized
+            changed = quantized != prev_quantized
+            floats = types == T_FLOAT
+            changed[floats] = snapshot.values[floats] != prev.values[floats]
+            changed |= types != prev.types
+        else:
+            changed = snapshot.values != prev.values  # also True for NaN
+        if self.version < 6:
+            changed[is_str | prev.is_str] = True
+            both_str = numpy.nonzero(is_str & prev.is_str)[0]
+            if len(both_str):
+                changed[both_str] = (strings[both_str] !=
+                                     prev.strings[both_str])
+
+        # sizes of the items in the output, and position of each item
+        # after the header byte of its group
+        if self.version > 4:
+            string_header = ""
+            sizes = self.item_sizes[types]
+        else:
+            string_header = STRING_HEADER
+            sizes = numpy.repeat(4, n)
+        changed_numbers = changed & ~is_str
+        changed_strs = numpy.nonzero(changed & is_str)[0]
+        sizes[~changed_numbers] = 0
+        for i in changed_strs:
+            sizes[i] = len(string_header) + 1 + len(strings[i])
+        positions = numpy.cumsum(sizes) - sizes
+        positions += numpy.arange(n) // 8 + 1
+        total = n // 8 + sizes.sum()
+
+        output = numpy.zeros(total, numpy.uint8)
+        groups = changed.reshape(-1, 8)
+        headers = (groups * (1 << numpy.arange(8))).sum(axis=1)
+        output[positions[::8] - 1] = headers
+
+        if self.version > 4:
+            integers = changed_numbers & (types != T_FLOAT)
+            self._write_integers(output, positions, quantized,
+                                 integers & (sizes == 1), 1)
+            self._write_integers(output, positions, quantized,
+                                 integers & (sizes == 2), 2)
+            self._write_floats(output, positions, snapshot.values,
+                               changed_numbers & (types == T_FLOAT))
+        else:
+            self._write_floats(output, positions, snapshot.values,
+                               changed_numbers)
+
+        for i in changed_strs:
+            data = string_header + chr(len(strings[i])) + strings[i]
+            output[positions[i] : positions[i] + len(data)] = (
+                numpy.frombuffer(data, numpy.uint8))
+        result = output.tostring()
+        if self.version >= 6:
+            result = self.strings.pop_added() + result
+        if self.version >= 7:
+            result = struct.pack("!d", snapshot.time) + result
+        return result
+
+    def _write_floats(self, output, positions, values, mask):
+        indices = numpy.nonzero(mask)[0]
+        floats = values[indices]
+        floats[floats != floats] = 0.0      # NaN
+        floats = floats.astype('>f4').view(numpy.uint8).reshape(-1, 4)
+        output[positions[indices][:, None] + numpy.arange(4)] = floats
+
+    def _write_integers(self, output, positions, integers, mask, size):
+        # big-endian; negative numbers in two's complement
+        indices = numpy.nonzero(mask)[0]
+        integers = integers[indices]
+        for k in range(size):
+            shift = 8 * (size - 1 - k)
+            output[positions[indices] + k] = (integers >> shift) & 0xFF
+
+
+def new_encoder(version=4):
+    if numpy is not None:
+        return SnapshotEncoder(version)
+    return PySnapshotEncoder(version)
@@ -0,0 +1,61 @@
+import struct
+import cStringIO
+import pytest
+
+import qdata
+import maploader
+from qdata import QMdl, QFrame, QMipmap
+
+
+def make_mdl(triangles=True, frames=2):
+    skinwidth, skinheight = 8, 4
+    vertices = [(0, 0, False), (4, 0, True), (4, 2, False), (0, 2, True)]
+    if triangles:
+        triangles = [(0, 1, 2, True), (0, 2, 3, False)]
+    else:
+        triangles = []
+    frames = [QFrame('frame%d' % i, [(0.0 + i, 0.0, 0.0, 5),
+                                     (10.0, 0.0, 0.0, 17),
+                                     (10.0, 10.0 + i, 0.0, 32),
+                                     (0.0, 10.0, 20.0, 100)])
+              for i in range(frames)]
+    mdl = QMdl(signature='IDPO', version=struct.pack("<i", 6),
+               scale=(1.0, 1.0, 1.0), scale_origin=(0.0, 0.0, 0.0),
+               boundingradius=20.0, eyeposition=(0.0, 0.0, 10.0),
+               numskins_=1, skinwidth=skinwidth, skinheight=skinheight,
+               numverts_=len(vertices), numtris_=len(triangles),
+               numframes_=len(frames), synctype='sync', flags=0, size=1.0,
+               skins=[QMipmap(w=skinwidth, h=skinheight,
+                              data=''.join(map(chr, range(32))))],
+               vertices=vertices, triangles=triangles, frames=frames)
+    return reload_mdl(mdl)
+
+def reload_mdl(mdl, arrays=False):
+    f = cStringIO.StringIO()
+    mdl.pack(f)
+    return QMdl(f.getvalue(), arrays=arrays)
+
+
+@pytest.mark.parametrize("arrays", [False, True])
+def test_pack_without_frames(arrays):
+    mdl = reload_mdl(make_mdl(), arrays)
+    scale = mdl.scale
+    mdl.frames = []
+    mdl = reload_mdl(mdl, arrays)
+    assert mdl.numframes_ == 0
+    assert mdl.frames == []
+    assert mdl.scale == scale
+
+
+@pytest.mark.parametrize("arrays", [False, True])
+@pytest.mark.parametrize("compact", [False, True])
+def test_load_model_without_triangles(monkeypatch, arrays, compact):
+    mdl = reload_mdl(make_mdl(triangles=False), arrays)
+    monkeypatch.setattr(maploader, 'CONTENT', {'progs/empty.mdl': mdl})
+    result = maploader.load_model('progs/empty.mdl', compact=compact)
+    assert result['faces'] == []
+    assert len(result['frames']) == 2
+    if compact:
+        frame = result['frames'][0]['a'][0]
+        assert frame['trivertx'] == ''.encode('base64')
+        assert frame['bboxmin'] == frame['bboxmax'] == result['scale_origin']
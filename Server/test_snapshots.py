@@ -0,0 +1,182 @@
+import random
+import struct
+import cStringIO
+import pytest
+
+import snapshots
+from snapshots import T_FLOAT, T_STRING, T_UINT8, T_UINT16, T_ORIGIN, T_ANGLE
+
+needs_numpy = pytest.mark.skipif(snapshots.numpy is None,
+                                 reason="numpy is not installed")
+
+
+TYPES = [T_STRING, T_FLOAT, T_UINT8, T_UINT16, T_ORIGIN, T_ANGLE]
+
+# values that are exactly halfway between two integers once scaled,
+# where numpy.round() and Python's round() disagree
+TIES = {
+    T_ORIGIN: [0.0625, -0.0625, 0.1875, -0.1875, 1.3125, -100.0625],
+    T_ANGLE: [0.703125, 2.109375, -0.703125, 358.59375, 359.296875],
+    T_UINT8: [0.5, 1.5, 2.5, 254.5, 255.5, -0.5],
+    T_UINT16: [0.5, 1.5, 2.5, 65534.5, 65535.5],
+}
+
+
+def random_value(t):
+    if t == T_STRING:
+        return random.choice(['', 'progs/player.mdl', 'abc'])
+    r = random.random()
+    if r < 0.03:
+        return float('nan')
+    if r < 0.4 and t in TIES:
+        return random.choice(TIES[t])
+    if t == T_ORIGIN:
+        return random.uniform(-5000, 5000)
+    if t == T_ANGLE:
+        return random.uniform(-720, 720)
+    if t == T_UINT8:
+        return float(random.choice([0, 1, 3, 300, -2]))
+    if t == T_UINT16:
+        return float(random.choice([0, 0x1000, 0x2001, 70000]))
+    return random.uniform(-10, 10)
+
+
+def test_quantize_ties():
+    assert snapshots.quantize(T_ORIGIN, 0.0625) == 1
+    assert snapshots.quantize(T_ORIGIN, -0.0625) == 0
+    assert snapshots.quantize(T_ORIGIN, 0.1875) == 2
+    assert snapshots.quantize(T_UINT8, 2.5) == 3
+    assert snapshots.quantize(T_UINT8, -0.5) == 0
+    assert snapshots.quantize(T_UINT16, 65535.5) == 0xFFFF
+
+
+@needs_numpy
+def test_get_quantized_matches_quantize():
+    random.seed(5)
+    for t in TIES:
+        values = TIES[t] + [random_value(t) for i in range(200)]
+        arrays = snapshots.SnapshotArrays(values, [t] * len(values))
+        got = arrays.get_quantized()[:len(values)].tolist()
+        assert got == [snapshots.quantize(t, v) for v in values]
+
+
+@needs_numpy
+def test_hide_entries_reuses_quantized():
+    random.seed(6)
+    types = [random.choice(TYPES) for i in range(90)]
+    snap = [random_value(t) for t in types]
+    empty = [random_value(t) for t in types[:9]]
+    parent = snapshots.SnapshotArrays(snap, types)
+    hidden = parent.hide_entries([0, 27, 81], empty)
+    replaced = hidden.replace_items(9, empty[:3])
+    got = replaced.get_quantized()
+    assert 'quantized' in parent.__dict__
+    culled = list(snap)
+    for index in [0, 27, 81]:
+        culled[index:index + 9] = empty
+    culled[9:12] = empty[:3]
+    expected = snapshots.SnapshotArrays(culled, types).get_quantized()
+    assert got.tolist() == expected.tolist()
+
+
+@needs_numpy
+@pytest.mark.parametrize("version", [4, 5, 6, 7])
+def test_encoders_agree(version):
+    random.seed(version)
+    for trial in range(100):
+        a = snapshots.SnapshotEncoder(version)
+        b = snapshots.PySnapshotEncoder(version)
+        types = [random.choice(TYPES) for i in range(random.randint(0, 40))]
+        snap = [random_value(t) for t in types]
+        for tick in range(10):
+            for k in range(random.randint(0, 5)):
+                if snap:
+                    i = random.randrange(len(snap))
+                    snap[i] = random_value(types[i])
+            time = tick * 0.1
+            r1 = a.encode(snapshots.SnapshotArrays(snap, types, time))
+            r2 = b.encode(snapshots.PySnapshot(snap, types, time))
+            assert r1 == r2, (version, trial, tick)
+
+
+class OriginalEncoder(object):
+    # frozen copy of the update_snapshot() of the original server, which
+    # defines protocol version 4
+    def __init__(self):
+        self.prev_snapshot = []
+
+    def update_snapshot(self, snapshot):
+        snapshot += [0.0] * ((-len(snapshot)) & 7)
+        prev_snapshot = self.prev_snapshot
+        if len(prev_snapshot) < len(snapshot):
+            prev_snapshot += [0.0] * (len(snapshot) - len(prev_snapshot))
+        f = cStringIO.StringIO()
+        header, header_bits, block = 0, 0, ""
+        for prev, entry in zip(prev_snapshot, snapshot):
+            if entry != prev:
+                header |= (1 << header_bits)
+                if isinstance(entry, str):
+                    nan_header = "\xff\xc0"
+                    block += nan_header + chr(len(entry)) + entry
+                else:
+                    if entry != entry:     # NaN?
+                        entry = 0.0
+                    block += struct.pack("!f", entry)
+            header_bits += 1
+            if header_bits == 8:
+                f.write(chr(header) + block)
+                header, header_bits, block = 0, 0, ""
+        assert header_bits == 0
+        self.prev_snapshot = snapshot
+        return f.getvalue()
+
+
+VERSION_4_STREAM = [
+    ([1.0, 'progs/player.mdl', 2.5, float('nan'), 0.0, -3.25],
+     '/?\x80\x00\x00\xff\xc0\x10progs/player.mdl@ \x00\x00\x00\x00'
+     '\x00\x00\xc0P\x00\x00'),
+    ([1.0, 'progs/player.mdl', 2.75, 0.0, 0.0, -3.25, 7.0, 'a', 1e-30],
+     '\xcc@0\x00\x00\x00\x00\x00\x00@\xe0\x00\x00\xff\xc0\x01a\x01'
+     '\r\xa2B`'),
+    ([1.0, 'x'],
+     '\xe6\xff\xc0\x01x' + '\x00' * 16),
+]
+
+def get_version_4_encoders():
+    # (encoder class, snapshot class) for the pure Python and the numpy
+    # versions
+    encoders = [(snapshots.PySnapshotEncoder, snapshots.PySnapshot)]
+    if snapshots.numpy is not None:
+        encoders.append((snapshots.SnapshotEncoder,
+                         snapshots.SnapshotArrays))
+    return encoders
+
+def test_version_4_frozen_stream():
+    original = OriginalEncoder()
+    for snapshot, expected in VERSION_4_STREAM:
+        assert original.update_snapshot(list(snapshot)) == expected
+    for encoder_class, snapshot_class in get_version_4_encoders():
+        encoder = encoder_class(4)
+        for snapshot, expected in VERSION_4_STREAM:
+            assert encoder.encode(snapshot_class(snapshot)) == expected
+
+def test_version_4_matches_original():
+    random.seed(4)
+    for encoder_class, snapshot_class in get_version_4_encoders():
+        for trial in range(100):
+            original = OriginalEncoder()
+            encoder = encoder_class(4)
+            types = [random.choice(TYPES)
+                     for i in range(random.randint(0, 40))]
+            snap = [random_value(t) for t in types]
+            for tick in range(10):
+                if random.random() < 0.2:
+                    types = [random.choice(TYPES)
+                             for i in range(random.randint(0, 40))]
+                    snap = [random_value(t) for t in types]
+                else:
+                    snap = [random_value(t) if random.random() < 0.2
+                            else x for t, x in zip(types, snap)]
+                expected = original.update_snapshot(list(snap))
+                got = encoder.encode(snapshot_class(snap))
+                assert got == expected, (trial, tick)
@@ -0,0 +1,121 @@
+import binascii
+
+
+CONTENTS_SOLID = -2
+
+
+class LevelVisibility(object):
+    """The potentially visible sets (PVS) of a BSP level.  Sets of leafs
+    are represented as Python integers used as bitsets: the bit 'n' is
+    set if the leaf 'n' is in the set.  Leaf 0 is the shared solid leaf,
+    which is never part of any set.
+    """
+
+    def __init__(self, bsp):
+        model = bsp.models[0]
+        self.headnode = model.node_id0
+        self.numleafs = model.numleafs
+        # flatten the nodes and planes into lists, for the tree walks
+        plane_ids, fronts, backs = bsp.nodes.get_columns(
+            ('plane_id', 'front', 'back'))
+        normals, dists = bsp.planes.get_columns(('normal', 'dist'))
+        self.node_normal = [tuple(normals[i]) for i in plane_ids]
+        self.node_dist = [dists[i] for i in plane_ids]
+        self.node_children = zip(fronts, backs)
+        types, self.leaf_vislist = bsp.leafs.get_columns(('type', 'vislist'))
+        self.leaf_solid = [type == CONTENTS_SOLID for type in types]
+        # the PVS of a leaf is only decompressed when it is first needed
+        self.visdata = bsp.visibility.rawdata
+        self.pvs_cache = {0: 0}
+
+    def get_pvs(self, leaf):
+        # the PVS of the leaf, like Mod_LeafPVS()
+        try:
+            return self.pvs_cache[leaf]
+        except KeyError:
+            pass
+        if leaf > self.numleafs:
+            result = 0      # a leaf of another model
+        elif self.leaf_vislist[leaf] < 0 or not len(self.visdata):
+            result = ((1 << self.numleafs) - 1) << 1    # everything
+        else:
+            result = self._decompress(self.visdata, self.leaf_vislist[leaf])
+        self.pvs_cache[leaf] = result
+        return result
+
+    def _decompress(self, visdata, ofs):
+        # like Mod_DecompressVis()
+        row = (self.numleafs + 7) >> 3
+        out = []
+        length = 0
+        while length < row:
+            c = visdata[ofs]
+            ofs += 1
+            if c != '\x00':
+                out.append(c)
+                length += 1
+            else:
+                count = ord(visdata[ofs])
+                ofs += 1
+                out.append('\x00' * count)
+                length += count
+        data = ''.join(out)[:row]
+        # the bit 'n' of the row is the leaf 'n + 1'
+        return int(binascii.hexlify(data[::-1]) or '0', 16) << 1
+
+    def point_leaf(self, (x, y, z)):
+        # like Mod_PointInLeaf()
+        node_id = self.headnode
+        while not node_id & 0x8000:
+            nx, ny, nz = self.node_normal[node_id]
+            d = nx * x + ny * y + nz * z - self.node_dist[node_id]
+            node_id = self.node_children[node_id][0 if d > 0 else 1]
+        return node_id ^ 0xffff
+
+    def box_leafs(self, mins, maxs):
+        # the set of non-solid leafs touched by the box
+        result = 0
+        for leaf in self.touched_leafs(mins, maxs):
+            result |= 1 << leaf
+        return result
+
+    def touched_leafs(self, mins, maxs):
+        # like SV_FindTouchedLeafs(): the list of non-solid leafs
+        # touched by the box
+        result = []
+        pending = [self.headnode]
+        while pending:
+            node_id = pending.pop()
+            if node_id & 0x8000:
+                leaf = node_id ^ 0xffff
+                if not self.leaf_solid[leaf]:
+                    result.append(leaf)
+                continue
+            # like BoxOnPlaneSide()
+            dmin = dmax = -self.node_dist[node_id]
+            for n, lo, hi in zip(self.node_normal[node_id], mins, maxs):
+                if n >= 0:
+                    dmin += n * lo
+                    dmax += n * hi
+                else:
+                    dmin += n * hi
+                    dmax += n * lo
+            front, back = self.node_children[node_id]
+            if dmax >= 0:
+                pending.append(front)
+            if dmin < 0:
+                pending.append(back)
+        return result
+
+    def fat_pvs(self, (x, y, z), radius=8.0):
+        # like SV_FatPVS() in QuakeWorld: the union of the PVS of all
+        # leafs near the point.  Returns None if the point is outside
+        # the level; then everything should be considered visible.
+        leafs = self.touched_leafs((x - radius, y - radius, z - radius),
+                                   (x + radius, y + radius, z + radius))
+        if not leafs:
+            return None
+        result = 0
+        for leaf in leafs:
+            result |= self.get_pvs(leaf)
+        return result
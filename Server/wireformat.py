@@ -0,0 +1,218 @@
+import sys, json, struct, array
+
+
+# Binary container for the results of maploader.load_level() and
+# load_model(), sent instead of JSON if the client accepts CONTENT_TYPE.
+#
+#    'VQBN'                 magic
+#    uint32                 FORMAT_VERSION
+#    uint32                 length of the header
+#    header                 JSON, padded with spaces to a multiple of 4
+#    data                   the buffers, each one aligned to 4 bytes
+#
+# The header is the same structure as the JSON answer, except that the
+# big lists are replaced with buffer references:
+#
+#    {"buffer": index, "type": type, "count": n, "components": k}
+#
+# where 'type' is "float32", "uint8", "uint16", "uint32" or "int32" (all
+# little endian), and "buffers" in the header is a list of [offset,
+# length] in the data section.  Buffers are used for:
+#
+#  * lists of numbers that are all integers or all floats, with 1
+#    component: the integers are uint16 or uint32 if none is negative,
+#    depending on the largest one, or else int32 (e.g. the arrays of
+#    'bsptree'); the floats are float32;
+#  * lists of {'x', 'y', 'z'} or {'x', 'y'}: float32 with 3 or 2
+#    components (positions, normals, uvs);
+#  * lists of {'r', 'g', 'b', 'a'}: uint8 with 4 components (palette);
+#  * the 'data' of textures, i.e. the base64 string: raw uint8 texels;
+#  * the 'trivertx' of compact model frames, also base64: uint8 with 4
+#    components;
+#  * lists of faces {'v': [indices], 't': texture}: replaced with a dict
+#    {'count': number of faces, 'v': all indices concatenated, 'sizes':
+#    number of indices of each face, 't': texture of each face}.  Other
+#    keys of the faces become lists with one item per face, or null.
+
+FORMAT_VERSION = 3
+CONTENT_TYPE = 'application/vnd.vivequake.binary'
+MAGIC = 'VQBN'
+
+ARRAY_TYPES = {
+    'float32': 'f',
+    'uint8': 'B',
+    'uint16': 'H',
+    'uint32': 'I',
+    'int32': 'i',
+}
+
+
+class BinaryEncoder(object):
+
+    def __init__(self):
+        self.buffers = []
+        self.data_size = 0
+
+    def add_buffer(self, type, values, components=1):
+        a = array.array(ARRAY_TYPES[type], values)
+        if sys.byteorder == 'big':
+            a.byteswap()
+        data = a.tostring()
+        index = len(self.buffers)
+        self.buffers.append((self.data_size, data))
+        self.data_size += (len(data) + 3) & ~3
+        return {'buffer': index, 'type': type,
+                'count': len(a) // components, 'components': components}
+
+    def add_indices(self, values):
+        if values and max(values) >= 65536:
+            return self.add_buffer('uint32', values)
+        return self.add_buffer('uint16', values)
+
+    def add_integers(self, values):
+        # the smallest type that holds all 'values', or None
+        lo = min(values)
+        hi = max(values)
+        if lo >= 0 and hi < 65536:
+            return self.add_buffer('uint16', values)
+        if lo >= 0 and hi < 1 << 32:
+            return self.add_buffer('uint32', values)
+        if lo >= -1 << 31 and hi < 1 << 31:
+            return self.add_buffer('int32', values)
+        return None
+
+    def encode_value(self, value):
+        if isinstance(value, dict):
+            result = {}
+            for key, x in value.items():
+                if key == 'data' and 'width' in value and 'height' in value:
+                    x = self.add_buffer('uint8', x.decode('base64'))
+                elif key == 'trivertx':
+                    x = self.add_buffer('uint8', x.decode('base64'),
+                                        components=4)
+                else:
+                    x = self.encode_value(x)
+                result[key] = x
+            return result
+        if isinstance(value, list) and value:
+            first = value[0]
+            if isinstance(first, dict):
+                keys = sorted(first)
+                if keys == ['x', 'y', 'z']:
+                    return self.add_buffer('float32', [c for v in value
+                                           for c in (v['x'], v['y'], v['z'])],
+                                           components=3)
+                if keys == ['x', 'y']:
+                    return self.add_buffer('float32', [c for v in value
+                                           for c in (v['x'], v['y'])],
+                                           components=2)
+                if keys == ['a', 'b', 'g', 'r']:
+                    return self.add_buffer('uint8', [c for v in value
+                                  for c in (v['r'], v['g'], v['b'], v['a'])],
+                                  components=4)
+                if 'v' in first and 't' in first:
+                    return self.encode_faces(value)
+            if all([type(x) is int for x in value]):
+                result = self.add_integers(value)
+                if result is not None:
+                    return result
+            if all([type(x) is float for x in value]):
+                return self.add_buffer('float32', value)
+            return [self.encode_value(x) for x in value]
+        return value
+
+    def encode_faces(self, faces):
+        indices = []
+        sizes = []
+        for face in faces:
+            indices += face['v']
+            sizes.append(len(face['v']))
+        result = {
+            'count': len(faces),
+            'v': self.add_indices(indices),
+            'sizes': self.add_indices(sizes),
+            't': self.add_indices([face['t'] for face in faces]),
+        }
+        extra_keys = set()
+        for face in faces:
+            extra_keys.update(face)
+        extra_keys.difference_update(['v', 't'])
+        for key in extra_keys:
+            result[key] = [face.get(key) for face in faces]
+        return result
+
+    def encode(self, response):
+        header = self.encode_value(response)
+        header['buffers'] = [[offset, len(data)]
+                             for offset, data in self.buffers]
+        header = json.dumps(header)
+        header += ' ' * ((-len(header)) & 3)
+        result = [MAGIC, struct.pack("<II", FORMAT_VERSION, len(header)),
+                  header]
+        for offset, data in self.buffers:
+            result.append(data)
+            result.append('\x00' * ((-len(data)) & 3))
+        return ''.join(result)
+
+
+def encode(response):
+    return BinaryEncoder().encode(response)
+
+
+def decode(data):
+    # The reverse of encode(), mostly for tests: returns the JSON-like
+    # structure, with the buffers turned back into lists of dicts.
+    assert data[:4] == MAGIC, "not a binary geometry container"
+    version, header_length = struct.unpack("<II", data[4:12])
+    assert version == FORMAT_VERSION, "unsupported version %d" % (version,)
+    header = json.loads(data[12 : 12 + header_length])
+    start = 12 + header_length
+    buffers = header.pop('buffers')
+
+    def read_buffer(ref):
+        offset, length = buffers[ref['buffer']]
+        a = array.array(ARRAY_TYPES[ref['type']])
+        a.fromstring(data[start + offset : start + offset + length])
+        if sys.byteorder == 'big':
+            a.byteswap()
+        return a.tolist()
+
+    def decode_value(value):
+        if isinstance(value, dict):
+            if 'buffer' in value:
+                values = read_buffer(value)
+                k = value['components']
+                if k == 1:
+                    return values
+                keys = {2: 'xy', 3: 'xyz', 4: 'rgba'}[k]
+                return [dict(zip(keys, values[i : i + k]))
+                        for i in range(0, len(values), k)]
+            if 'sizes' in value and 'count' in value:
+                return decode_faces(value)
+            result = {}
+            for key, x in value.items():
+                if key in ('data', 'trivertx') and isinstance(x, dict):
+                    x = ''.join(map(chr, read_buffer(x))).encode('base64')
+                else:
+                    x = decode_value(x)
+                result[key] = x
+            return result
+        if isinstance(value, list):
+            return [decode_value(x) for x in value]
+        return value
+
+    def decode_faces(value):
+        indices = read_buffer(value['v'])
+        faces = []
+        i = 0
+        for n, t in zip(read_buffer(value['sizes']), read_buffer(value['t'])):
+            faces.append({'v': indices[i : i + n], 't': t})
+            i += n
+        for key, x in value.items():
+            if key not in ('count', 'v', 'sizes', 't'):
+                for face, item in zip(faces, x):
+                    if item is not None:
+                        face[key] = item
+        return faces
+
+    return decode_value(header)